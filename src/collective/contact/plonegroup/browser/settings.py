@@ -1,38 +1,55 @@
 # -*- coding: utf-8 -*-
+from bisect import bisect_left
 from collective.contact.plonegroup import _
 from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
+from collective.contact.plonegroup.config import FUNCTIONS_REGISTRY
 from collective.contact.plonegroup.config import get_registry_functions
 from collective.contact.plonegroup.config import get_registry_organizations
+from collective.contact.plonegroup.config import invalidate_registry_snapshot
 from collective.contact.plonegroup.config import PLONEGROUP_ORG
+from collective.contact.plonegroup.config import SNAPSHOT_REGISTRIES
 from collective.contact.plonegroup.events import PlonegroupGroupCreatedEvent
+from collective.contact.plonegroup.mapping import get_groups_mapping
+from collective.contact.plonegroup.sync import get_sync_plan
+from collective.contact.plonegroup.sync import plan_functions_change
+from collective.contact.plonegroup.sync import plan_organizations_change
+from collective.contact.plonegroup.sync import sync_plan
 from collective.contact.plonegroup.utils import get_all_suffixes
+from collective.contact.plonegroup.utils import get_full_title
+from collective.contact.plonegroup.utils import get_full_titles
+from collective.contact.plonegroup.utils import get_functions_index
+from collective.contact.plonegroup.utils import get_not_empty_plone_groups
 from collective.contact.plonegroup.utils import get_organizations
 from collective.contact.plonegroup.utils import get_own_organization_path
 from collective.contact.plonegroup.utils import get_plone_group_id
+from collective.contact.plonegroup.utils import get_plone_group_title
+from collective.contact.plonegroup.utils import get_plonegroup_batch
+from collective.contact.plonegroup.utils import get_plonegroup_generation
+from collective.contact.plonegroup.utils import invalidate_full_titles
+from collective.contact.plonegroup.utils import invalidate_plonegroup_caches
+from collective.contact.plonegroup.utils import organization_title_changed
+from collective.contact.plonegroup.utils import plone_group_exists
+from collective.contact.plonegroup.utils import queue_before_commit
 from collective.elephantvocabulary import wrap_vocabulary
 from collective.z3cform.datagridfield import DataGridFieldFactory
 from collective.z3cform.datagridfield.registry import DictRow
-from imio.helpers.cache import get_cachekey_volatile
-from imio.helpers.cache import invalidate_cachekey_volatile_for
-from imio.helpers.content import safe_encode
 from operator import attrgetter
 from plone import api
 from plone.api.exc import InvalidParameterError
 from plone.app.registry.browser.controlpanel import ControlPanelFormWrapper
 from plone.app.registry.browser.controlpanel import RegistryEditForm
-from plone.app.uuid.utils import uuidToObject
 from plone.autoform.directives import widget
 from plone.memoize import ram
-from plone.memoize.interfaces import ICacheChooser
 from plone.registry.interfaces import IRecordModifiedEvent
 from plone.z3cform import layout
+from Products.CMFPlone.utils import safe_unicode
 from Products.statusmessages.interfaces import IStatusMessage
+from z3c.form import button
 from z3c.form import form
 from z3c.form.browser.checkbox import CheckBoxFieldWidget
 from zExceptions import Redirect
 from zope import schema
 from zope.component import getMultiAdapter
-from zope.component import getUtility
 from zope.component.hooks import getSite
 from zope.container.interfaces import IContainerModifiedEvent
 from zope.container.interfaces import IObjectRemovedEvent
@@ -41,11 +58,14 @@ from zope.interface import implements
 from zope.interface import Interface
 from zope.interface import Invalid
 from zope.interface import invariant
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
 from zope.schema.interfaces import IVocabularyFactory
 from zope.schema.vocabulary import SimpleTerm
 from zope.schema.vocabulary import SimpleVocabulary
 
+import heapq
 import re
+import unicodedata
 
 
 class IOrganizationSchema(Interface):
@@ -87,7 +107,12 @@ class IFunctionSchema(Interface):
 
 
 def voc_cache_key(method, self, context):
-    return get_cachekey_volatile("%s.%s" % (self.__class__.__module__, self.__class__.__name__))
+    return ("%s.%s" % (self.__class__.__module__, self.__class__.__name__), get_plonegroup_generation())
+
+
+def organizations_tree_cache_key(method, self, root_portal_type, root_id):
+    return (self.__class__.__module__, self.__class__.__name__, root_portal_type, root_id,
+            get_plonegroup_generation())
 
 
 class BaseOrganizationServicesVocabulary(object):
@@ -98,23 +123,47 @@ class BaseOrganizationServicesVocabulary(object):
     valid_states = ('active',)
 
     def listSubOrganizations(self, terms, folder, parent_label=''):
-        # query sub organizations if any to query
-        if folder.objectIds():
-            catalog = api.portal.get_tool('portal_catalog')
-            folder_path = '/'.join(folder.getPhysicalPath())
-            brains = catalog.unrestrictedSearchResults(
-                portal_type='organization',
-                review_state=self.valid_states,
-                path={'query': folder_path, 'depth': 1},
-                sort_on='getObjPositionInParent'
-            )
-            for brain in brains:
+        """
+            Append terms of every sub organizations of p_folder (object or path).
+            Sub organizations are got with one catalog query, the tree is rebuilt from brains paths
+            so no object is loaded. Organizations contained in a not valid one are not listed.
+        """
+        if not isinstance(folder, basestring):
+            folder = '/'.join(folder.getPhysicalPath())
+        catalog = api.portal.get_tool('portal_catalog')
+        brains = catalog.unrestrictedSearchResults(
+            portal_type='organization',
+            review_state=self.valid_states,
+            path={'query': folder},
+            sort_on='getObjPositionInParent'
+        )
+        # {parent_path: [children brains]}, order in parent is kept as brains are sorted on position
+        children = {}
+        for brain in brains:
+            children.setdefault(brain.getPath().rsplit('/', 1)[0], []).append(brain)
+        self._append_children(terms, children, folder, parent_label)
+
+    def _uses_object_hooks(self):
+        """Return True if a subclass overrides _term_value, _term_token or _term_title, that receive objects."""
+        klass = self.__class__
+        return bool([name for name in ('_term_value', '_term_token', '_term_title')
+                     if getattr(klass, name).im_func is not getattr(BaseOrganizationServicesVocabulary, name).im_func])
+
+    def _append_children(self, terms, children, parent_path, parent_label, use_objects=None):
+        """Append terms of children of p_parent_path, each followed by its own children."""
+        if use_objects is None:
+            use_objects = self._uses_object_hooks()
+        for brain in children.get(parent_path, ()):
+            if use_objects:
+                # organizations are only loaded for subclasses overriding the object methods
                 orga = brain._unrestrictedGetObject()
                 term_title = self._term_title(orga, parent_label)
-                term_value = self._term_value(orga)
-                term_token = self._term_token(orga)
-                terms.append(SimpleTerm(term_value, term_token, term_title))
-                self.listSubOrganizations(terms, orga, term_title)
+                term = SimpleTerm(self._term_value(orga), self._term_token(orga), term_title)
+            else:
+                term_title = self._brain_term_title(brain, parent_label)
+                term = SimpleTerm(self._brain_term_value(brain), self._brain_term_token(brain), term_title)
+            terms.append(term)
+            self._append_children(terms, children, brain.getPath(), term_title, use_objects)
 
     def _term_value(self, orga):
         '''Method that render term value, separated to ease override.'''
@@ -131,29 +180,52 @@ class BaseOrganizationServicesVocabulary(object):
             term_title = "%s - %s" % (parent_label, term_title)
         return term_title
 
-    def __call__(self, context, root_portal_type='organization', root_id=PLONEGROUP_ORG):
-        portal = getSite()
+    def _brain_term_value(self, brain):
+        '''Method that render term value from a brain, separated to ease override.'''
+        return brain.UID
+
+    def _brain_term_token(self, brain):
+        '''Method that render term token from a brain, separated to ease override.'''
+        return brain.UID
+
+    def _brain_term_title(self, brain, parent_label):
+        '''Method that render term title from a brain, separated to ease override.'''
+        term_title = safe_unicode(brain.Title)
+        if parent_label:
+            term_title = u"%s - %s" % (parent_label, term_title)
+        return term_title
+
+    @ram.cache(organizations_tree_cache_key)
+    def _get_terms(self, root_portal_type, root_id):
+        """Return terms, cached until an organization is added, moved, modified or transitioned."""
         terms = []
-        pcat = portal.portal_catalog
+        pcat = api.portal.get_tool('portal_catalog')
         brains = pcat.unrestrictedSearchResults(portal_type=root_portal_type, id=root_id)
         if not brains:
             terms.append(SimpleTerm(None, token="unfound",
                                     title=_(u"You must define one '${root_portal_type}' with id '${pgo}' !",
                                             mapping={'root_portal_type': root_portal_type,
                                                      'pgo': root_id, })))
-            return SimpleVocabulary(terms)
         elif len(brains) > 1:
             terms.append(SimpleTerm(None, token="multifound",
                                     title=_(u"You must have only one '${root_portal_type}' "
                                             "with id '${pgo}' !",
                                             mapping={'root_portal_type': root_portal_type,
                                                      'pgo': root_id})))
-            return SimpleVocabulary(terms)
+        else:
+            self.listSubOrganizations(terms, brains[0].getPath())
+        return tuple(terms)
 
-        own_orga = brains[0]._unrestrictedGetObject()
-        self.listSubOrganizations(terms, own_orga)
+    @ram.cache(organizations_tree_cache_key)
+    def _get_search_index(self, root_portal_type, root_id):
+        """Return the search index of terms, cached with them so it is not rebuilt at each search."""
+        return SearchableSimpleVocabulary(list(self._get_terms(root_portal_type, root_id)))._build_search_index()
 
-        return SimpleVocabulary(terms)
+    def __call__(self, context, root_portal_type='organization', root_id=PLONEGROUP_ORG):
+        # a new vocabulary is returned as callers may change it
+        vocab = SearchableSimpleVocabulary(list(self._get_terms(root_portal_type, root_id)))
+        vocab._search_index = self._get_search_index(root_portal_type, root_id)
+        return vocab
 
 
 class OwnOrganizationServicesVocabulary(BaseOrganizationServicesVocabulary):
@@ -205,6 +277,16 @@ class IContactPlonegroupConfig(Interface):
     )
     widget('groups_management', CheckBoxFieldWidget, multiple='multiple', size=15)
 
+    deferred_groups_sync_threshold = schema.Int(
+        title=_(u'Defer Plone groups synchronization above this number of changes'),
+        description=_(u"When saving the configuration changes more Plone groups than this number, "
+                      u"Plone groups are created, modified or deleted later by the synchronization jobs worker. "
+                      u"0 to never defer."),
+        required=False,
+        default=0,
+        min=0,
+    )
+
     @invariant
     def validateSettings(data):
         if not data.organizations:
@@ -214,6 +296,8 @@ class IContactPlonegroupConfig(Interface):
         if not data.functions:
             raise Invalid(_(u"You must define at least one function !"))
 
+        # rules to check, in order: (suffix, org uids kept, ignore '<not found>' users, message, mapping key)
+        checks = []
         # only able to delete a function (suffix) if every linked Plone groups are empty
         stored_suffixes = get_all_suffixes()
         saved_suffixes = [func['fct_id'] for func in data.functions]
@@ -221,72 +305,76 @@ class IContactPlonegroupConfig(Interface):
         for removed_suffix in removed_suffixes:
             # check that every organizations including not selected
             # linked suffixed Plone group is empty
-            for org_uid in get_organizations(only_selected=False, the_objects=False):
-                plone_group_id = get_plone_group_id(org_uid, removed_suffix)
-                plone_group = api.group.get(plone_group_id)
-                if plone_group and plone_group.getMemberIds():
-                    raise Invalid(
-                        _(u"can_not_remove_function_every_plone_groups_not_empty",
-                          mapping={'removed_function': removed_suffix,
-                                   'plone_group_id': plone_group_id}))
+            checks.append((removed_suffix, (), False,
+                           _(u"can_not_remove_function_every_plone_groups_not_empty"), 'removed_function'))
 
         # only able to select orgs for an existing function (suffix) if
         # every linked Plone groups of not selected orgs are empty
-        stored_functions = get_registry_functions()
+        stored_functions = get_registry_functions(frozen=True)
+        # fct_orgs of the frozen snapshot are tuples, compared as lists with the form values
         old_functions = {dic['fct_id']: {'fct_title': dic['fct_title'],
-                                         'fct_orgs': dic['fct_orgs'],
+                                         'fct_orgs': list(dic['fct_orgs'] or []),
                                          'enabled': dic['enabled']}
                          for dic in stored_functions}
         new_functions = {dic['fct_id']: {'fct_title': dic['fct_title'],
-                                         'fct_orgs': dic['fct_orgs'],
+                                         'fct_orgs': list(dic['fct_orgs'] or []),
                                          'enabled': dic['enabled']}
                          for dic in data.functions}
         for new_function, new_function_infos in new_functions.items():
+            # a new function has no stored fct_orgs
             if new_function_infos['fct_orgs'] and \
-               old_functions[new_function]['fct_orgs'] != new_function_infos['fct_orgs']:
+               old_functions.get(new_function, {}).get('fct_orgs', []) != new_function_infos['fct_orgs']:
                 # check that Plone group is empty for not selected fct_orgs
-                for org_uid in get_organizations(only_selected=False, the_objects=False):
-                    if org_uid in new_function_infos['fct_orgs']:
-                        continue
-                    plone_group_id = get_plone_group_id(org_uid, new_function)
-                    plone_group = api.group.get(plone_group_id)
-                    # use getGroupMembers to ignore '<not found>' users
-                    if plone_group and plone_group.getGroupMembers():
-                        raise Invalid(
-                            _(u"can_not_select_function_orgs_every_other_plone_groups_not_empty",
-                              mapping={'function': new_function,
-                                       'plone_group_id': plone_group_id}))
+                # ignore '<not found>' users like getGroupMembers
+                checks.append((new_function, new_function_infos['fct_orgs'], True,
+                               _(u"can_not_select_function_orgs_every_other_plone_groups_not_empty"), 'function'))
             elif new_function_infos['enabled'] is False:
                 # check that Plone groups are all empty
-                for org_uid in get_organizations(only_selected=False, the_objects=False):
-                    plone_group_id = get_plone_group_id(org_uid, new_function)
-                    plone_group = api.group.get(plone_group_id)
-                    # use getGroupMembers to ignore '<not found>' users
-                    if plone_group and plone_group.getGroupMembers():
-                        raise Invalid(
-                            _(u"can_not_disable_suffix_plone_groups_not_empty",
-                              mapping={'disabled_function': new_function,
-                                       'plone_group_id': plone_group_id}))
+                checks.append((new_function, (), True,
+                               _(u"can_not_disable_suffix_plone_groups_not_empty"), 'disabled_function'))
+        # nothing to check, like when only a function title changed
+        if not checks:
+            return
+
+        # non empty Plone groups of checked suffixes are computed at once
+        org_uids = get_organizations(only_selected=False, the_objects=False)
+        checked_ids = [[get_plone_group_id(org_uid, check[0]) for org_uid in org_uids if org_uid not in check[1]]
+                       for check in checks]
+        not_empty = get_not_empty_plone_groups([plone_group_id for plone_group_ids in checked_ids
+                                                for plone_group_id in plone_group_ids])
+        # only groups having members are checked again for '<not found>' users
+        not_empty_found = get_not_empty_plone_groups(
+            [plone_group_id for check, plone_group_ids in zip(checks, checked_ids) if check[2]
+             for plone_group_id in plone_group_ids if plone_group_id in not_empty],
+            ignore_not_found=True)
+        for (suffix, kept_orgs, ignore_not_found, msg, key), plone_group_ids in zip(checks, checked_ids):
+            not_empty_ids = not_empty_found if ignore_not_found else not_empty
+            for plone_group_id in plone_group_ids:
+                if plone_group_id in not_empty_ids:
+                    raise Invalid(_(msg, mapping={key: suffix, 'plone_group_id': plone_group_id}))
 
 
 def addOrModifyGroup(orga, function_id, function_title):
     """
         create a plone group
     """
-    organization_title = orga.get_full_title(separator=' - ', first_index=1)
-    organization_title = safe_encode(organization_title)
-    function_title = safe_encode(function_title)
-    group_name = get_plone_group_id(orga.UID(), function_id)
+    orga_uid = orga.UID()
+    group_name = get_plone_group_id(orga_uid, function_id)
     group = api.group.get(groupname=group_name)
-    group_title = '%s (%s)' % (organization_title, function_title)
+    group_title = get_plone_group_title(get_full_title(orga, separator=' - ', first_index=1), function_title)
+    mapping = get_groups_mapping()
     if group is None:
         group = api.group.create(
             groupname=group_name,
             title=group_title,
         )
+        if mapping is not None:
+            mapping.add(orga_uid, function_id, group_name)
         notify(PlonegroupGroupCreatedEvent(group))
         return True
     else:
+        if mapping is not None:
+            mapping.add(orga_uid, function_id, group_name)
         # group_title is maybe modified
         # portal_groups.editGroup(group_name, utf8)
         pg = api.portal.get_tool('portal_groups')
@@ -297,40 +385,9 @@ def addOrModifyGroup(orga, function_id, function_title):
     return False
 
 
-def invalidate_sopgv_cache():
-    """
-        invalidate cache of selectedOrganizationsPloneGroupsVocabulary
-    """
-    cache_chooser = getUtility(ICacheChooser)
-    thecache = cache_chooser('collective.contact.plonegroup.browser.settings.'
-                             'selectedOrganizationsPloneGroupsVocabulary')
-    thecache.ramcache.invalidate('collective.contact.plonegroup.browser.settings.'
-                                 'selectedOrganizationsPloneGroupsVocabulary')
-
-
-def invalidate_sov_cache():
-    """
-        invalidate cache of selectedOrganizationsVocabulary
-    """
-    cache_chooser = getUtility(ICacheChooser)
-    thecache = cache_chooser('collective.contact.plonegroup.browser.settings.selectedOrganizationsVocabulary')
-    thecache.ramcache.invalidate('collective.contact.plonegroup.browser.settings.selectedOrganizationsVocabulary')
-
-
-def invalidate_soev_cache():
-    """
-        invalidate cache of SelectedOrganizationsElephantVocabulary
-    """
-    invalidate_cachekey_volatile_for(
-        'collective.contact.plonegroup.browser.settings.SelectedOrganizationsElephantVocabulary')
-
-
-def invalidate_ssoev_cache():
-    """
-        invalidate cache of SortedSelectedOrganizationsElephantVocabulary
-    """
-    invalidate_cachekey_volatile_for(
-        'collective.contact.plonegroup.browser.settings.SortedSelectedOrganizationsElephantVocabulary')
+# BBB, every plonegroup cache now depends on the plonegroup generation
+invalidate_sopgv_cache = invalidate_sov_cache = invalidate_soev_cache = invalidate_ssoev_cache = \
+    invalidate_plonegroup_caches
 
 
 def detectContactPlonegroupChange(event):
@@ -338,99 +395,29 @@ def detectContactPlonegroupChange(event):
         Manage our record changes
     """
     if IRecordModifiedEvent.providedBy(event):  # and event.record.interface == IContactPlonegroupConfig:
-        changes = False
+        if event.record.__name__ in SNAPSHOT_REGISTRIES:
+            # done here too so it does not depend on the order of subscribers registration
+            invalidate_registry_snapshot(event.record.__name__)
+        if event.record.__name__ == FUNCTIONS_REGISTRY:
+            # compile new functions right now, it will not change until next functions modification
+            get_functions_index(rebuild=True)
+        batch = get_plonegroup_batch()
+        if batch is not None and batch.flushing:
+            # Plone groups are synchronized once by the batch when every records are written
+            return
         # this can be called before plonegroup is installed and registry contains relevant keys
         try:
-            registry_orgs = get_registry_organizations()
+            registry_orgs = get_registry_organizations(frozen=True)
         except InvalidParameterError:
             registry_orgs = []
+        # first compute Plone groups changes then apply it
+        plan = None
         if event.record.fieldName == 'organizations' and registry_orgs:
-            old_set = set(event.oldValue)
-            new_set = set(event.newValue)
-            # we detect a new organization
-            add_set = new_set.difference(old_set)
-            for orga_uid in add_set:
-                orga = uuidToObject(orga_uid)
-                for fct_dic in get_registry_functions():
-                    enabled = fct_dic['enabled']
-                    if enabled is False:
-                        continue
-                    fct_orgs = fct_dic['fct_orgs']
-                    if fct_orgs and orga_uid not in fct_orgs:
-                        continue
-                    if addOrModifyGroup(orga, fct_dic['fct_id'], fct_dic['fct_title']):
-                        changes = True
-            # we detect a removed organization. We dont do anything on exsiting groups
-            if old_set.difference(new_set):
-                changes = True
+            plan = plan_organizations_change(event.oldValue, event.newValue)
         elif event.record.fieldName == 'functions' and registry_orgs:
-            old_functions = {dic['fct_id']: {'fct_title': dic['fct_title'],
-                                             'fct_orgs': dic['fct_orgs'],
-                                             'enabled': dic['enabled']}
-                             for dic in event.oldValue}
-            old_set = set(old_functions.keys())
-            new_functions = {dic['fct_id']: {'fct_title': dic['fct_title'],
-                                             'fct_orgs': dic['fct_orgs'],
-                                             'enabled': dic['enabled']}
-                             for dic in event.newValue}
-            new_set = set(new_functions.keys())
-            # we detect a new function
-            add_set = new_set.difference(old_set)
-            for new_id in add_set:
-                new_title = new_functions[new_id]['fct_title']
-                new_orgs = new_functions[new_id]['fct_orgs']
-                enabled = new_functions[new_id]['enabled']
-                for orga_uid in registry_orgs:
-                    if new_orgs and orga_uid not in new_orgs:
-                        continue
-                    if enabled is False:
-                        continue
-                    orga = uuidToObject(orga_uid)
-                    if addOrModifyGroup(orga, new_id, new_title):
-                        changes = True
-            # we detect a removed function
-            # We may remove Plone groups as we checked before that every are empty
-            removed_set = old_set.difference(new_set)
-            for removed_id in removed_set:
-                for orga_uid in get_organizations(only_selected=False, the_objects=False):
-                    plone_group_id = get_plone_group_id(orga_uid, removed_id)
-                    plone_group = api.group.get(plone_group_id)
-                    if plone_group:
-                        api.group.delete(plone_group_id)
-                        changes = True
-            # we detect existing functions for which 'fct_orgs' changed
-            for new_id, new_function_infos in new_functions.items():
-                new_title = new_function_infos['fct_title']
-                new_orgs = new_function_infos['fct_orgs']
-                enabled = new_function_infos['enabled']
-                if not new_orgs and enabled is True:
-                    # we have to make sure Plone groups are created for every selected organizations
-                    for orga_uid in registry_orgs:
-                        orga = uuidToObject(orga_uid)
-                        if addOrModifyGroup(orga, new_id, new_title):
-                            changes = True
-                else:
-                    # fct_orgs changed, we remove every linked Plone groups
-                    # except ones defined in new_orgs
-                    for orga_uid in get_organizations(only_selected=False, the_objects=False):
-                        if enabled is True and orga_uid in new_orgs:
-                            # make sure Plone group is created or updated if suffix title changed
-                            orga = uuidToObject(orga_uid)
-                            if addOrModifyGroup(orga, new_id, new_title):
-                                changes = True
-                        else:
-                            # make sure Plone group is deleted
-                            plone_group_id = get_plone_group_id(orga_uid, new_id)
-                            plone_group = api.group.get(plone_group_id)
-                            if plone_group:
-                                api.group.delete(plone_group_id)
-                                changes = True
-
-        if changes:
-            invalidate_sopgv_cache()
-            invalidate_sov_cache()
-            invalidate_soev_cache()
-            invalidate_ssoev_cache()
+            plan = plan_functions_change(event.oldValue, event.newValue, registry_orgs=registry_orgs)
+        if plan is not None and sync_plan(plan):
+            invalidate_plonegroup_caches()
 
 
 class SettingsEditForm(RegistryEditForm):
@@ -440,6 +427,19 @@ class SettingsEditForm(RegistryEditForm):
     form.extends(RegistryEditForm)
     schema = IContactPlonegroupConfig
 
+    @button.buttonAndHandler(_(u'Preview Plone groups changes'), name='preview')
+    def handle_preview(self, action):
+        """Show Plone groups changes that saving would do, nothing is saved."""
+        data, errors = self.extractData()
+        if errors:
+            self.status = self.formErrorsMessage
+            return
+        summary = get_sync_plan(organizations=data['organizations'], functions=data['functions']).summary()
+        IStatusMessage(self.request).addStatusMessage(
+            _(u"Saving will create ${create} Plone groups, change the title of ${retitle} "
+              u"Plone groups and delete ${delete} Plone groups.", mapping=summary),
+            type='info')
+
 
 SettingsView = layout.wrap_form(SettingsEditForm, ControlPanelFormWrapper)
 
@@ -449,7 +449,7 @@ def addOrModifyOrganizationGroups(organization, uid):
         Modify groups linked to an organization
     """
     changes = False
-    for dic in get_registry_functions():
+    for dic in get_registry_functions(frozen=True):
         if addOrModifyGroup(organization, dic['fct_id'], dic['fct_title']):
             changes = True
     return changes
@@ -471,9 +471,8 @@ def adaptPloneGroupDefinition(organization, event):
     if not organization_path.startswith(
        get_own_organization_path(not_found_value='unfound')):  # can be unfound too
         return
-    portal = getSite()
     # when an organization is removed (and its content), we check if it is used in plonegroup configuration
-    registry_orgs = get_registry_organizations()
+    registry_orgs = get_registry_organizations(frozen=True)
     if IObjectRemovedEvent.providedBy(event) and organization.UID() in registry_orgs:
         smi = IStatusMessage(organization.REQUEST)
         smi.addStatusMessage(_('You cannot delete this item !'), type='error')
@@ -483,27 +482,46 @@ def adaptPloneGroupDefinition(organization, event):
         organization.REQUEST['RESPONSE'].redirect(view_url)
         raise Redirect(view_url)
         return
-    pcat = portal.portal_catalog
-    brains = pcat(portal_type='organization', path=organization_path)
+    # nothing to do if the title did not change, like when editing a phone number
+    if IObjectModifiedEvent.providedBy(event) and not organization_title_changed(organization, event):
+        return
+    # full titles of the organization and sub organizations may have changed,
+    # make sure it is done before Plone groups titles are computed
+    invalidate_full_titles(organization.UID())
+    if not registry_orgs:
+        return
+    # Plone groups of every changed subtrees are updated once before commit
+    queue_before_commit('plonegroup_groups_sync', syncOrganizationsGroups, set())[0].add(organization_path)
+
+
+def syncOrganizationsGroups(organization_paths):
+    """
+        Add or modify Plone groups of selected organizations under p_organization_paths.
+    """
+    registry_orgs = get_registry_organizations(frozen=True)
+    if not registry_orgs:
+        return
+    # a path under another one is useless
+    paths = []
+    for path in sorted(organization_paths):
+        if not paths or not path.startswith(paths[-1] + '/'):
+            paths.append(path)
+    # only selected organizations of the subtrees are loaded
+    pcat = api.portal.get_tool('portal_catalog')
+    brains = pcat.unrestrictedSearchResults(UID=list(registry_orgs), path=paths)
     changes = False
     for brain in brains:
-        orga = brain.getObject()
-        orga_uid = orga.UID()
-        if orga_uid in registry_orgs:
-            if addOrModifyOrganizationGroups(orga, orga_uid):
-                changes = True
+        if addOrModifyOrganizationGroups(brain._unrestrictedGetObject(), brain.UID):
+            changes = True
     if changes:
-        invalidate_sopgv_cache()
-        invalidate_sov_cache()
-        invalidate_soev_cache()
-        invalidate_ssoev_cache()
+        invalidate_plonegroup_caches()
 
 
 def sopgv_cache_key(function, functions=[], group_title=True):
     """
         calculate the cache key
     """
-    return (set(functions), group_title)
+    return (set(functions), group_title, get_plonegroup_generation())
 
 
 @ram.cache(sopgv_cache_key)  # not used
@@ -514,16 +532,22 @@ def selectedOrganizationsPloneGroupsVocabulary(functions=[], group_title=True):
     terms = []
     # if no function given, use all functions
     functions = functions or get_all_suffixes()
-    for orga_uid in get_registry_organizations():
+    registry_orgs = get_registry_organizations(frozen=True)
+    if not group_title:
+        org_titles = get_full_titles(registry_orgs, separator=' - ', first_index=1)
+    for orga_uid in registry_orgs:
         for fct_id in functions:
             group_id = "%s_%s" % (orga_uid, fct_id)
-            group = api.group.get(groupname=group_id)
-            if group is not None:
-                if group_title:
-                    title = group.getProperty('title')
-                else:
-                    title = uuidToObject(orga_uid).get_full_title(separator=' - ', first_index=1)
-                terms.append(SimpleTerm(group_id, token=group_id, title=title))
+            if not plone_group_exists(group_id):
+                continue
+            if group_title:
+                group = api.group.get(groupname=group_id)
+                if group is None:
+                    continue
+                title = group.getProperty('title')
+            else:
+                title = org_titles[orga_uid]
+            terms.append(SimpleTerm(group_id, token=group_id, title=title))
     return SimpleVocabulary(terms)
 
 
@@ -538,22 +562,17 @@ def unrestrictedUuidToObject(uid):
 
 def getSelectedOrganizations(separator=' - ', first_index=1):
     """ Return a list of tuples (uid, title) """
-    ret = []
-    registry_orgs = get_registry_organizations()
+    registry_orgs = get_registry_organizations(frozen=True)
     # needed to get as manager because plone.formwidget.masterselect calls ++widget++ as Anonymous
     if api.user.is_anonymous():
         with api.env.adopt_roles(['Manager']):
-            for orga_uid in registry_orgs:
-                title = unrestrictedUuidToObject(orga_uid).get_full_title(separator=separator, first_index=first_index)
-                ret.append((orga_uid, title))
+            titles = get_full_titles(registry_orgs, separator=separator, first_index=first_index)
     else:
-        for orga_uid in registry_orgs:
-            title = uuidToObject(orga_uid).get_full_title(separator=separator, first_index=first_index)
-            ret.append((orga_uid, title))
-    return ret
+        titles = get_full_titles(registry_orgs, separator=separator, first_index=first_index)
+    return [(orga_uid, titles[orga_uid]) for orga_uid in registry_orgs]
 
 
-@ram.cache(lambda *args: True)  # not used
+@ram.cache(lambda *args: get_plonegroup_generation())  # not used
 def selectedOrganizationsVocabulary():
     """
         Returns a vocabulary of selected organizations
@@ -562,15 +581,89 @@ def selectedOrganizationsVocabulary():
     return SimpleVocabulary(terms)
 
 
+SEARCH_WORDS_SEPARATOR = re.compile(r'\W+', re.UNICODE)
+
+
+def normalize_search_text(text):
+    """
+        Return p_text lowercased and without accents.
+    """
+    text = unicodedata.normalize('NFKD', safe_unicode(text or u''))
+    return u''.join([char for char in text if not unicodedata.combining(char)]).lower()
+
+
+def split_search_words(text):
+    """
+        Return normalized words of p_text.
+    """
+    return [word for word in SEARCH_WORDS_SEPARATOR.split(normalize_search_text(text)) if word]
+
+
 class SearchableSimpleVocabulary(SimpleVocabulary):
+    """
+        SimpleVocabulary searchable on terms title.
+        A sorted index of title words prefixes is built on first search and kept with the vocabulary,
+        or given by the vocabulary factory when it is cached.
+    """
+
+    _search_index = None
+
+    def _build_search_index(self):
+        words = []
+        titles = []
+        titles_words = []
+        for position, term in enumerate(self._terms):
+            title_words = split_search_words(term.title)
+            titles.append(u' '.join(title_words))
+            titles_words.append(frozenset(title_words))
+            words.extend([(word, position) for word in set(title_words)])
+        words.sort()
+        self._search_index = ([word for word, position in words],
+                              [position for word, position in words],
+                              titles,
+                              titles_words)
+        return self._search_index
+
+    def _prefix_positions(self, word):
+        """Return positions of terms having a title word starting with p_word."""
+        words, positions = self._search_index[0], self._search_index[1]
+        found = set()
+        for i in xrange(bisect_left(words, word), len(words)):
+            if not words[i].startswith(word):
+                break
+            found.add(positions[i])
+        return found
 
     def search(self, query, limit=50):
-        # transform query in a regexp
-        regexp = u' '.join([u'{}.*'.format(p) for p in query.split(' ')])
-        regexp = re.compile(regexp, re.I)
-        return [
-            term for term in self._terms if re.search(regexp, term.title)
-        ]
+        """
+            Return terms having, for each word of p_query, a title word starting with it.
+            Terms whose title starts with p_query come first, then terms matching whole words,
+            then vocabulary order.
+        """
+        if self._search_index is None:
+            self._build_search_index()
+        query_words = split_search_words(query)
+        if not query_words:
+            return list(self._terms[:limit])
+        candidates = None
+        # longest words first as they are the most selective
+        for word in sorted(set(query_words), key=len, reverse=True):
+            positions = self._prefix_positions(word)
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates:
+                return []
+        normalized_query = u' '.join(query_words)
+        titles, titles_words = self._search_index[2], self._search_index[3]
+
+        def rank(position):
+            return (not titles[position].startswith(normalized_query),
+                    -len(titles_words[position].intersection(query_words)),
+                    position)
+        if limit is None:
+            positions = sorted(candidates, key=rank)
+        else:
+            positions = heapq.nsmallest(limit, candidates, key=rank)
+        return [self._terms[position] for position in positions]
 
 
 class SelectedOrganizationsElephantVocabulary(OwnOrganizationServicesVocabulary):
@@ -581,7 +674,7 @@ class SelectedOrganizationsElephantVocabulary(OwnOrganizationServicesVocabulary)
         vocab = super(SelectedOrganizationsElephantVocabulary, self).__call__(context)
         terms = vocab.by_value
         ordered_terms = []
-        for uid in get_registry_organizations():
+        for uid in get_registry_organizations(frozen=True):
             if uid in terms:
                 ordered_terms.append(terms[uid])
                 del terms[uid]
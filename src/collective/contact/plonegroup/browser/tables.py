@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
+from collections import deque
 from collective.contact.core.content.organization import IOrganization
 from collective.contact.plonegroup import _
 from collective.contact.plonegroup.config import get_registry_organizations
 from collective.contact.plonegroup.config import PLONEGROUP_ORG
+from collective.contact.plonegroup.indexers import FULL_TITLE_INDEX
+from collective.contact.plonegroup.indexers import full_title_index_built
 from collective.contact.plonegroup.interfaces import IPloneGroupContact
 from collective.contact.plonegroup.utils import get_all_suffixes
+from collective.contact.plonegroup.utils import get_full_title
+from collective.contact.plonegroup.utils import get_full_titles
+from collective.contact.plonegroup.utils import get_functions_index
+from collective.contact.plonegroup.utils import get_group_member_counts
 from collective.contact.plonegroup.utils import get_plone_group_id
 from collective.eeafaceted.z3ctable.browser.views import ExtendedCSSTable
 from collective.eeafaceted.z3ctable.columns import ActionsColumn
@@ -16,10 +23,14 @@ from plone import api
 from Products.CMFCore.permissions import ManagePortal
 from Products.CMFCore.utils import _checkPermission
 from Products.CMFPlone.utils import base_hasattr
+from Products.CMFPlone.utils import safe_unicode
 from Products.Five import BrowserView
 from zope.cachedescriptors.property import CachedProperty
 from zope.i18n import translate
 
+import cgi
+import json
+
 
 class SubOrganizationsTable(ExtendedCSSTable):
     """Table that displays templates info."""
@@ -28,8 +39,8 @@ class SubOrganizationsTable(ExtendedCSSTable):
     cssClassOdd = u'odd'
     cssClasses = {'table': 'listing nosort suborganizations-listing icons-on'}
 
-    batchSize = 999
-    startBatchingAt = 999
+    batchSize = 50
+    startBatchingAt = 50
     sortOn = None
     results = []
 
@@ -69,16 +80,20 @@ class SubOrganizationsTableView(BrowserView):
         self.table = self.__table__(self.context, self.request)
         self.table.__name__ = u'suborganizations'
         catalog = api.portal.get_tool('portal_catalog')
-        brains = catalog.searchResults(**self.query_dict())
-
-        def keys(brain):
-            """Order by get_full_title that displays organizations and sub organizations."""
-            obj = brain.getObject()
-            return obj.get_full_title()
-
-        # sort by parent path and by position
-        # the catalog search returns also context, remove it
-        self.table.results = [brain for brain in sorted(brains, key=keys) if brain.UID != self.context.UID()]
+        query = self.query_dict()
+        if full_title_index_built(catalog):
+            # order by full title that displays organizations and sub organizations,
+            # sorted by the catalog so only organizations of the displayed batch are loaded
+            query['sort_on'] = FULL_TITLE_INDEX
+            # the catalog search returns also context, remove it
+            query['UID'] = {'not': self.context.UID()}
+            self.table.results = catalog.searchResults(**query)
+        else:
+            # index not installed or not filled, upgrade step not run
+            brains = catalog.searchResults(**query)
+            titles = get_full_titles([brain.UID for brain in brains])
+            self.table.results = [brain for brain in sorted(brains, key=lambda brain: titles.get(brain.UID))
+                                  if brain.UID != self.context.UID()]
         self.table.update()
 
     def render_original_suborgs(self):
@@ -112,7 +127,7 @@ class OrgaPrettyLinkWithAdditionalInfosColumn(PrettyLinkWithAdditionalInfosColum
                 # 1 considering that PLONEGROUP is at 1st level.
                 # Otherwise must use get_organizations_chain
                 first_index = 1
-            return item.get_full_title(first_index=first_index)
+            return get_full_title(item, first_index=first_index)
         else:
             return item.get_full_title()
 
@@ -126,6 +141,8 @@ class DisplayGroupUsersView(BrowserView):
         self.context = context
         self.request = request
         self.portal_url = api.portal.get().absolute_url()
+        # {group_id: members}
+        self._group_members = {}
 
     def _check_auth(self, group_id):
         """When using '*' make it possible to check if authorized."""
@@ -167,20 +184,41 @@ class DisplayGroupUsersView(BrowserView):
                 group_title = group_title.split('(')[-1][:-1]
         return group_title
 
+    def _get_group_members(self, group):
+        """Return members of p_group, cached for the groups displayed by this view
+           as they often share the same sub groups."""
+        group_id = group.getId()
+        if group_id not in self._group_members:
+            self._group_members[group_id] = group.getAllGroupMembers()
+        return self._group_members[group_id]
+
     def _get_groups_and_members(self, group, index=0, keep_subgroups=False):
-        """ """
+        """Return (level, principal) for users of p_group and of its sub groups, breadth first.
+           If p_keep_subgroups, sub groups are returned too and a user is listed under every sub group,
+           either a user is only listed once.
+           A sub group is only expanded once so cycles in groups are ignored."""
         members = []
-        if keep_subgroups and index != 0:
-            members.append((index, group))
-            index += 1
-        for principal in group.getAllGroupMembers():
-            isGroup = base_hasattr(principal, 'isGroup') and principal.isGroup() or 0
-            if isGroup:
-                members += self._get_groups_and_members(principal, index + 1, keep_subgroups)
-            else:
+        listed_user_ids = set()
+        visited_group_ids = set([group.getId()])
+        queue = deque([(group, index)])
+        while queue:
+            current, level = queue.popleft()
+            for principal in self._get_group_members(current):
+                isGroup = base_hasattr(principal, 'isGroup') and principal.isGroup() or 0
+                principal_id = principal.getId()
+                if isGroup:
+                    if principal_id in visited_group_ids:
+                        continue
+                    visited_group_ids.add(principal_id)
+                    if keep_subgroups:
+                        members.append((level + 1, principal))
+                        queue.append((principal, level + 2))
+                    else:
+                        queue.append((principal, level + 1))
                 # avoid 2 times same member whith sub groups and keep_subgroups=False
-                if keep_subgroups or (principal not in [p for i, p in members]):
-                    members.append((index, principal))
+                elif keep_subgroups or principal_id not in listed_user_ids:
+                    listed_user_ids.add(principal_id)
+                    members.append((level, principal))
         return members
 
     def group_users(self, group):
@@ -210,8 +248,7 @@ class DisplayGroupUsersView(BrowserView):
         for index, principal in self._get_groups_and_members(group, keep_subgroups=self.is_manager):
             # member may be a user or group
             isGroup = base_hasattr(principal, 'isGroup') and principal.isGroup() or 0
-            principal_title = principal.getProperty('fullname') or \
-                principal.getProperty('title') or principal.getId()
+            principal_title = self._principal_title(principal)
             if self.is_manager:
                 principal_title = principal_title + " ({0})".format(principal.id)
             principal_title = "<div class='user-or-group user-or-group-level-{0}'>{1}</div>".format(
@@ -224,12 +261,56 @@ class DisplayGroupUsersView(BrowserView):
         # just keep values
         return "".join([v[2] for v in res])
 
+    def _principal_title(self, principal):
+        """Return the title displayed for a user or a group."""
+        return principal.getProperty('fullname') or principal.getProperty('title') or principal.getId()
+
     @property
     def _is_manager(self):
         """ """
         return _checkPermission(ManagePortal, self.context)
 
 
+class DisplayGroupsUsersJSONView(DisplayGroupUsersView):
+    """
+      View that returns as JSON the users of many Plone groups in one request.
+      Groups are given by id (p_group_ids) or by organization UID (p_org_uids),
+      every suffixed Plone groups of an organization are then returned.
+      Principals are only described once:
+      {'groups': {group_id: {'title': title, 'members': [[level, principal_id], ...]}},
+       'principals': {principal_id: [title, is_group]}}
+    """
+
+    def __call__(self, group_ids=[], org_uids=[]):
+        self.is_manager = self._is_manager
+        if isinstance(group_ids, basestring):
+            group_ids = [group_ids]
+        if isinstance(org_uids, basestring):
+            org_uids = [org_uids]
+        group_ids = list(group_ids)
+        for org_uid in org_uids:
+            self._check_auth(org_uid)
+            group_ids += [get_plone_group_id(org_uid, suffix) for suffix in self._get_suffixes(org_uid)]
+        groups = {}
+        principals = {}
+        for group_id in group_ids:
+            if group_id in groups:
+                continue
+            group = api.group.get(group_id)
+            if group is None:
+                continue
+            members = []
+            for index, principal in self._get_groups_and_members(group, keep_subgroups=self.is_manager):
+                principal_id = principal.getId()
+                if principal_id not in principals:
+                    isGroup = base_hasattr(principal, 'isGroup') and principal.isGroup() or 0
+                    principals[principal_id] = [self._principal_title(principal), bool(isGroup)]
+                members.append([index, principal_id])
+            groups[group_id] = {'title': group.getProperty('title'), 'members': members}
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps({'groups': groups, 'principals': principals})
+
+
 class PloneGroupUsersGroupsColumn(BaseColumn):
     """Column that displays Plone groups and users linked to an organization."""
 
@@ -237,9 +318,23 @@ class PloneGroupUsersGroupsColumn(BaseColumn):
     weight = 5
     short = True
 
+    @CachedProperty
+    def member_counts(self):
+        """
+            Number of members of every Plone groups of selected organizations displayed in the table,
+            computed once for the table. Rows are batched when cells are rendered.
+        """
+        plonegroup_organizations = get_registry_organizations(frozen=True)
+        # a row is a list of (item, column, colspan)
+        org_uids = [row[0][0].UID for row in self.table.rows if row and row[0][0].UID in plonegroup_organizations]
+        group_ids = [get_plone_group_id(org_uid, suffix)
+                     for org_uid in org_uids
+                     for suffix in get_all_suffixes(org_uid)]
+        return get_group_member_counts(group_ids)
+
     def renderCell(self, item):
         """ """
-        plonegroup_organizations = get_registry_organizations()
+        plonegroup_organizations = get_registry_organizations(frozen=True)
         org_uid = item.UID
         if org_uid not in plonegroup_organizations:
             return "-"
@@ -248,10 +343,16 @@ class PloneGroupUsersGroupsColumn(BaseColumn):
         group_ids = [get_plone_group_id(org_uid, suffix)
                      for suffix in suffixes]
         url_group_ids = '&group_ids='.join(group_ids)
+        # number of members by suffix, no user is loaded
+        functions = get_functions_index().by_id
+        counts = u"".join([u"<span class=\"pg_group_count\" title=\"{0}\">{1}: {2}</span>".format(
+            cgi.escape(group_id, quote=True), cgi.escape(safe_unicode(functions[suffix]['fct_title'])),
+            self.member_counts.get(group_id, 0))
+            for suffix, group_id in zip(suffixes, group_ids)])
         # use _ for i18ndude machinery
         details_msg = _('Details')
         details_msg = translate(details_msg, context=self.request)
-        res = u"<div id=\"group-users\" class=\"collapsible\" onclick=\"toggleDetails(" \
+        res = counts + u"<div id=\"group-users\" class=\"collapsible\" onclick=\"toggleDetails(" \
             u"'collapsible-group-users_{0}', toggle_parent_active=false, parent_tag=null, " \
             u"load_view='@@display-group-users?group_ids={1}&short:boolean={2}', base_url='{3}');\"> {4}</div>" \
             u"<div id=\"collapsible-group-users_{0}\" class=\"collapsible-content\" style=\"display: none;\">" \
@@ -279,7 +380,7 @@ class SelectedInPlonegroupColumn(BooleanColumn):
 
     def getValue(self, item):
         """ """
-        plonegroup_organizations = get_registry_organizations()
+        plonegroup_organizations = get_registry_organizations(frozen=True)
         org_uid = item.UID
         return bool(org_uid in plonegroup_organizations)
 
@@ -8,13 +8,20 @@ from collective.contact.plonegroup.interfaces import IDGFListField
 from collective.contact.plonegroup.interfaces import IDGFVocabularyField
 from collective.contact.plonegroup.interfaces import IGroupField
 from collective.contact.plonegroup.interfaces import IOrganizationField
+from collective.contact.plonegroup.mapping import rebuild_groups_mapping
+from collective.contact.plonegroup.references import rebuild_references_index
+from collective.contact.plonegroup.sync import get_sync_jobs
+from collective.contact.plonegroup.sync import process_sync_jobs
+from collective.contact.plonegroup.sync import SYNC_JOB_CHUNK_SIZE
+from collective.contact.plonegroup.utils import get_full_title
 from collective.contact.plonegroup.utils import get_organization
 from collective.contact.plonegroup.utils import get_plone_group_id
 from collective.z3cform.datagridfield import DataGridField
 from collective.z3cform.datagridfield import DictRow
-from operator import methodcaller
 from plone import api
+from plone.protect import CheckAuthenticator
 from Products.CMFPlone import PloneMessageFactory as PMF
+from Products.Five import BrowserView
 from z3c.form import button
 from z3c.form import field
 from z3c.form.form import EditForm
@@ -110,7 +117,7 @@ class GroupsConfigurationAdapter(object):
                     values.append({'group': group_id, 'user': user.id})
             self.old_values[name] = values
         else:
-            for org in sorted(self.form.functions_orgs[name], key=methodcaller('get_full_title')):
+            for org in sorted(self.form.functions_orgs[name], key=get_full_title):
                 org_uid = org.UID()
                 group_id = get_plone_group_id(org_uid, name)
                 users = api.user.get_users(groupname=group_id)
@@ -293,3 +300,78 @@ class ManageOwnGroupUsers(EditForm):
     @button.buttonAndHandler(PMF(u'return_to_view'), name='cancel')
     def handleCancel(self, action):
         self.request.response.redirect(self.request.get('URL1'))
+
+
+class ProtectedActionView(BrowserView):
+    """
+        Maintenance action changing the site, a confirmation form is displayed on GET,
+        the action is only done on POST with a valid authenticator by the apply method
+        that subclasses must define.
+    """
+
+    label = u''
+    description = u''
+
+    def __call__(self):
+        if self.request.get('REQUEST_METHOD', 'GET') != 'POST':
+            return self.index()
+        CheckAuthenticator(self.request)
+        return self.apply()
+
+
+class RebuildGroupsMappingView(ProtectedActionView):
+    """
+        Rebuild the plonegroup groups mapping from existing Plone groups.
+    """
+
+    label = _(u'Rebuild plonegroup groups mapping')
+    description = _(u'Register every existing Plone group using a defined function in the groups mapping.')
+
+    def apply(self):
+        count = rebuild_groups_mapping()
+        api.portal.show_message(
+            message=_(u'Plonegroup groups mapping rebuilt with ${count} Plone groups.',
+                      mapping={'count': count}),
+            request=self.request)
+        self.request.response.redirect('{0}/@@contact-plonegroup-settings'.format(
+            api.portal.get().absolute_url()))
+
+
+class RebuildReferencesIndexView(ProtectedActionView):
+    """
+        Rebuild the catalog index of UIDs referenced in content fields.
+    """
+
+    label = _(u'Rebuild plonegroup references index')
+    description = _(u'Reindex organizations UIDs referenced in the fields of every content.')
+
+    def apply(self):
+        count = rebuild_references_index()
+        api.portal.show_message(
+            message=_(u'Plonegroup references index rebuilt for ${count} objects.',
+                      mapping={'count': count}),
+            request=self.request)
+        self.request.response.redirect('{0}/@@contact-plonegroup-settings'.format(
+            api.portal.get().absolute_url()))
+
+
+class ProcessSyncJobsView(ProtectedActionView):
+    """
+        Apply pending Plone groups sync jobs, commits after each chunk.
+        Returns the state of every job, a cron must call sync.process_sync_jobs with 'bin/instance run'.
+        Failed jobs are retried if 'retry_failed' is given.
+    """
+
+    label = _(u'Process plonegroup sync jobs')
+    description = _(u'Apply pending Plone groups changes saved for later.')
+
+    def apply(self):
+        chunk_size = int(self.request.get('chunk_size', SYNC_JOB_CHUNK_SIZE))
+        count = process_sync_jobs(chunk_size=chunk_size, retry_failed=bool(self.request.get('retry_failed')))
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        lines = ['{0} operations applied.'.format(count)]
+        for job in get_sync_jobs():
+            lines.append('{0} ({1}): {2}, {3}/{4} operations{5}'.format(
+                job['id'], job['created'], job['status'], job['position'], len(job['operations']),
+                job['error'] and ', {0}'.format(job['error']) or ''))
+        return '\n'.join(lines)
@@ -1,36 +1,141 @@
 # -*- coding: utf-8 -*-
 
-from copy import deepcopy
+from imio.helpers.cache import get_cachekey_volatile
+from imio.helpers.cache import invalidate_cachekey_volatile_for
 from plone import api
+from plone.api.exc import InvalidParameterError
 
 
 # Registry keys
 ORGANIZATIONS_REGISTRY = 'collective.contact.plonegroup.browser.settings.IContactPlonegroupConfig.organizations'
 FUNCTIONS_REGISTRY = 'collective.contact.plonegroup.browser.settings.IContactPlonegroupConfig.functions'
 GROUPS_MGT_REGISTRY = 'collective.contact.plonegroup.browser.settings.IContactPlonegroupConfig.groups_management'
+DEFERRED_SYNC_REGISTRY = \
+    'collective.contact.plonegroup.browser.settings.IContactPlonegroupConfig.deferred_groups_sync_threshold'
 PLONEGROUP_ORG = 'plonegroup-organization'
 DEFAULT_DIRECTORY_ID = 'contacts'
 
+# registry records for which a frozen snapshot is kept in memory
+SNAPSHOT_REGISTRIES = (ORGANIZATIONS_REGISTRY, FUNCTIONS_REGISTRY, GROUPS_MGT_REGISTRY)
 
-def get_registry_organizations(as_copy=True):
-    org_uids = api.portal.get_registry_record(ORGANIZATIONS_REGISTRY) or []
-    if as_copy:
-        org_uids = deepcopy(org_uids)
-    return org_uids
+# process wide snapshots, {(portal_path, record_name): (cachekey, frozen_value)}
+_registry_snapshots = {}
 
 
-def get_registry_functions(as_copy=True):
-    functions = api.portal.get_registry_record(FUNCTIONS_REGISTRY) or []
-    if as_copy:
-        functions = deepcopy(functions)
-    return functions
+class FrozenDict(dict):
+    """
+        Read only dict used in registry snapshots.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("'%s' object does not support item assignment" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(value):
+    """
+        Return an immutable (tuple/frozenset/FrozenDict based) version of value.
+    """
+    if isinstance(value, dict):
+        return FrozenDict([(k, freeze(v)) for k, v in value.items()])
+    if isinstance(value, (list, tuple)):
+        return tuple([freeze(v) for v in value])
+    if isinstance(value, (set, frozenset)):
+        return frozenset([freeze(v) for v in value])
+    return value
+
+
+def thaw(value):
+    """
+        Return a new mutable version of a value returned by freeze.
+    """
+    if isinstance(value, dict):
+        return dict([(k, thaw(v)) for k, v in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return set([thaw(v) for v in value])
+    return value
+
 
+def get_registry_snapshot(record_name):
+    """
+        Return a frozen snapshot of registry record p_record_name.
+        The snapshot is shared by every caller and only rebuilt when the record is modified,
+        see invalidate_registry_snapshot.
+    """
+    portal = api.portal.get()
+    key = ('/'.join(portal.getPhysicalPath()), record_name)
+    cachekey = get_cachekey_volatile(record_name)
+    cached = _registry_snapshots.get(key)
+    if cached is not None and cached[0] == cachekey:
+        return cached[1]
+    value = freeze(api.portal.get_registry_record(record_name) or [])
+    _registry_snapshots[key] = (cachekey, value)
+    return value
 
-def get_registry_groups_mgt(as_copy=True):
-    groups = api.portal.get_registry_record(GROUPS_MGT_REGISTRY) or []
+
+def invalidate_registry_snapshot(record_name):
+    """
+        Invalidate snapshot of registry record p_record_name.
+    """
+    invalidate_cachekey_volatile_for(record_name, get_again=True)
+
+
+def _get_registry_value(record_name, as_copy, frozen):
+    if frozen:
+        return get_registry_snapshot(record_name)
     if as_copy:
-        groups = deepcopy(groups)
-    return groups
+        return thaw(get_registry_snapshot(record_name))
+    return api.portal.get_registry_record(record_name) or []
+
+
+def get_registry_organizations(as_copy=True, frozen=False):
+    """
+        Return selected organization uids.
+        If frozen, return the shared read only snapshot (tuple), no copy is made.
+        If as_copy, return a new list, either return the value stored in the registry.
+    """
+    return _get_registry_value(ORGANIZATIONS_REGISTRY, as_copy, frozen)
+
+
+def get_registry_functions(as_copy=True, frozen=False):
+    """
+        Return defined functions.
+        If frozen, return the shared read only snapshot (tuple of FrozenDict), no copy is made.
+        If as_copy, return a new list of dicts, either return the value stored in the registry.
+    """
+    return _get_registry_value(FUNCTIONS_REGISTRY, as_copy, frozen)
+
+
+def get_registry_groups_mgt(as_copy=True, frozen=False):
+    """
+        Return global groups that can be managed.
+        If frozen, return the shared read only snapshot (tuple), no copy is made.
+        If as_copy, return a new list, either return the value stored in the registry.
+    """
+    return _get_registry_value(GROUPS_MGT_REGISTRY, as_copy, frozen)
+
+
+def get_registry_deferred_sync_threshold():
+    """
+        Return the number of Plone groups changes above which synchronization is deferred, 0 to never defer.
+    """
+    try:
+        return api.portal.get_registry_record(DEFERRED_SYNC_REGISTRY) or 0
+    except InvalidParameterError:
+        # record not available before upgrade
+        return 0
 
 
 def set_registry_organizations(value):
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from collective.contact.plonegroup import logger
+from collective.contact.widget.interfaces import IContactContent
+from plone import api
+from plone.indexer import indexer
+from Products.CMFPlone.utils import base_hasattr
+from Products.CMFPlone.utils import safe_unicode
+
+import transaction
+
+
+# sortable catalog index storing the full title of contact content
+FULL_TITLE_INDEX = 'plonegroup_full_title'
+# number of reindexed objects between two savepoints in rebuild_full_title_index
+FULL_TITLE_BATCH_SIZE = 1000
+# attribute set on a catalog index once it has been rebuilt for every content,
+# stored on the index so it is lost when the index is removed and added again
+INDEX_BUILT_MARKER = '_plonegroup_built'
+
+
+@indexer(IContactContent)
+def plonegroup_full_title(obj):
+    """
+        Index the full title, used to sort organizations and sub organizations
+        without loading them. Kept up to date when an organization or a parent is renamed or moved.
+    """
+    if not base_hasattr(obj, 'get_full_title'):
+        raise AttributeError
+    return safe_unicode(obj.get_full_title())
+
+
+def reindex_full_titles(paths):
+    """
+        Reindex FULL_TITLE_INDEX of contents under p_paths, containers included.
+        Moved contents are reindexed by Plone, this is needed when a title is modified.
+    """
+    catalog = api.portal.get_tool('portal_catalog')
+    if FULL_TITLE_INDEX not in catalog.indexes():
+        return
+    # a path under another one is useless
+    kept = []
+    for path in sorted(paths):
+        if not [parent for parent in kept if path.startswith(parent + '/')]:
+            kept.append(path)
+    if not kept:
+        return
+    for brain in catalog.unrestrictedSearchResults(path={'query': kept}):
+        obj = brain._unrestrictedGetObject()
+        catalog.catalog_object(obj, uid=brain.getPath(), idxs=[FULL_TITLE_INDEX], update_metadata=0)
+
+
+def index_built(index_name, catalog=None):
+    """
+        Return True if catalog index p_index_name is installed and was rebuilt for every content
+        (see set_index_built). Contents indexed one by one since the index was added do not count.
+    """
+    if catalog is None:
+        catalog = api.portal.get_tool('portal_catalog')
+    if index_name not in catalog.indexes():
+        return False
+    return getattr(catalog._catalog.getIndex(index_name), INDEX_BUILT_MARKER, False)
+
+
+def set_index_built(index_name, built=True, catalog=None):
+    """
+        Mark catalog index p_index_name as rebuilt for every content, or not if not p_built.
+    """
+    if catalog is None:
+        catalog = api.portal.get_tool('portal_catalog')
+    setattr(catalog._catalog.getIndex(index_name), INDEX_BUILT_MARKER, built)
+
+
+def full_title_index_built(catalog=None):
+    """
+        Return True if FULL_TITLE_INDEX is installed and rebuilt, contents not indexed
+        (index added to a site with content but not rebuilt) would be missing when sorting on it.
+    """
+    return index_built(FULL_TITLE_INDEX, catalog)
+
+
+def rebuild_full_title_index(batch_size=FULL_TITLE_BATCH_SIZE):
+    """
+        Reindex FULL_TITLE_INDEX for every contact content, a savepoint is done every p_batch_size objects.
+        Must be called on existing sites when the index is added.
+    """
+    catalog = api.portal.get_tool('portal_catalog')
+    if FULL_TITLE_INDEX not in catalog.indexes():
+        logger.warn('Catalog index {0} is not installed!'.format(FULL_TITLE_INDEX))
+        return 0
+    count = 0
+    for brain in catalog.unrestrictedSearchResults(object_provides=IContactContent.__identifier__):
+        obj = brain._unrestrictedGetObject()
+        catalog.catalog_object(obj, uid=brain.getPath(), idxs=[FULL_TITLE_INDEX], update_metadata=0)
+        count += 1
+        if count % batch_size == 0:
+            transaction.savepoint(optimistic=True)
+            catalog._p_jar.cacheGC()
+            logger.info('Plonegroup full title index: {0} objects reindexed.'.format(count))
+    set_index_built(FULL_TITLE_INDEX, catalog=catalog)
+    logger.info('Plonegroup full title index rebuilt for {0} objects.'.format(count))
+    return count
@@ -28,6 +28,45 @@ class IPlonegroupGroupCreatedEvent(IPASEvent):
     """
 
 
+class IPlonegroupGroupsMapping(Interface):
+    """
+        Local utility mapping organization UID and suffix to Plone group id and back.
+    """
+
+    def add(org_uid, suffix, group_id):
+        """Register group_id as the Plone group of org_uid and suffix."""
+
+    def remove(group_id):
+        """Unregister group_id, return True if it was registered."""
+
+    def get_group_id(org_uid, suffix, default=None):
+        """Return the Plone group id of org_uid and suffix."""
+
+    def get_group_ids(org_uid):
+        """Return a dict {suffix: group_id} of existing Plone groups of org_uid."""
+
+    def get_org_and_suffix(group_id, default=None):
+        """Return (org_uid, suffix) of group_id."""
+
+    def __contains__(group_id):
+        """Is group_id a registered Plone group?"""
+
+    def add_member(principal_id, group_id):
+        """Register principal_id as member of registered group_id."""
+
+    def remove_member(principal_id, group_id):
+        """Unregister principal_id as member of group_id."""
+
+    def remove_principal(principal_id):
+        """Unregister every memberships of principal_id."""
+
+    def get_principal_orgs(principal_id, suffix):
+        """Return org_uids for which principal_id is member of the Plone group using suffix."""
+
+    def clear():
+        """Unregister every Plone groups and memberships."""
+
+
 class IGroupField(Interface):
     """
         Interface for the GroupField
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+from Acquisition import aq_base
+from BTrees.OOBTree import OOBTree
+from collective.contact.plonegroup import logger
+from collective.contact.plonegroup.config import get_registry_functions
+from collective.contact.plonegroup.interfaces import IPlonegroupGroupsMapping
+from persistent import Persistent
+from plone import api
+from Products.PluggableAuthService.interfaces import events as pas_events
+from zope.component import queryUtility
+from zope.interface import implementer
+
+
+# the mapping is only kept up to date when PAS notifies group events (>= 1.11.3), see pasevents
+HAS_PAS_GROUP_EVENTS = hasattr(pas_events, 'IGroupCreatedEvent') and \
+    hasattr(pas_events, 'IPrincipalAddedToGroupEvent') and \
+    hasattr(pas_events, 'IPrincipalRemovedFromGroupEvent')
+
+
+@implementer(IPlonegroupGroupsMapping)
+class PlonegroupGroupsMapping(Persistent):
+    """
+        Bidirectional mapping between organization UID/suffix and Plone group id.
+        by_org stores {org_uid: {suffix: group_id}}, by_group stores {group_id: (org_uid, suffix)}.
+        memberships stores direct members of registered groups {principal_id: {suffix: frozenset(org_uids)}}.
+    """
+
+    def __init__(self):
+        self.by_org = OOBTree()
+        self.by_group = OOBTree()
+        self.memberships = OOBTree()
+
+    def add(self, org_uid, suffix, group_id):
+        # avoid useless writes
+        if self.by_group.get(group_id) == (org_uid, suffix):
+            return
+        self.remove(group_id)
+        self.by_group[group_id] = (org_uid, suffix)
+        suffixes = dict(self.by_org.get(org_uid, {}))
+        suffixes[suffix] = group_id
+        self.by_org[org_uid] = suffixes
+
+    def remove(self, group_id):
+        org_and_suffix = self.by_group.get(group_id)
+        if org_and_suffix is None:
+            return False
+        del self.by_group[group_id]
+        org_uid, suffix = org_and_suffix
+        suffixes = dict(self.by_org.get(org_uid, {}))
+        suffixes.pop(suffix, None)
+        if suffixes:
+            self.by_org[org_uid] = suffixes
+        elif org_uid in self.by_org:
+            del self.by_org[org_uid]
+        return True
+
+    def get_group_id(self, org_uid, suffix, default=None):
+        return self.by_org.get(org_uid, {}).get(suffix, default)
+
+    def get_group_ids(self, org_uid):
+        return dict(self.by_org.get(org_uid, {}))
+
+    def get_org_and_suffix(self, group_id, default=None):
+        return self.by_group.get(group_id, default)
+
+    def __contains__(self, group_id):
+        return group_id in self.by_group
+
+    def add_member(self, principal_id, group_id):
+        org_and_suffix = self.by_group.get(group_id)
+        if org_and_suffix is None:
+            return False
+        org_uid, suffix = org_and_suffix
+        suffixes = dict(self.memberships.get(principal_id, {}))
+        org_uids = suffixes.get(suffix, frozenset())
+        if org_uid in org_uids:
+            return False
+        suffixes[suffix] = org_uids.union([org_uid])
+        self.memberships[principal_id] = suffixes
+        return True
+
+    def remove_member(self, principal_id, group_id):
+        org_and_suffix = self.by_group.get(group_id)
+        if org_and_suffix is None or principal_id not in self.memberships:
+            return False
+        org_uid, suffix = org_and_suffix
+        suffixes = dict(self.memberships[principal_id])
+        org_uids = suffixes.get(suffix, frozenset())
+        if org_uid not in org_uids:
+            return False
+        org_uids = org_uids.difference([org_uid])
+        if org_uids:
+            suffixes[suffix] = org_uids
+        else:
+            del suffixes[suffix]
+        if suffixes:
+            self.memberships[principal_id] = suffixes
+        else:
+            del self.memberships[principal_id]
+        return True
+
+    def remove_principal(self, principal_id):
+        if principal_id in self.memberships:
+            del self.memberships[principal_id]
+            return True
+        return False
+
+    def get_principal_orgs(self, principal_id, suffix):
+        return self.memberships.get(principal_id, {}).get(suffix, frozenset())
+
+    def clear(self):
+        self.by_org.clear()
+        self.by_group.clear()
+        self.memberships.clear()
+
+
+def get_groups_mapping():
+    """
+        Return the IPlonegroupGroupsMapping local utility,
+        None if not installed (upgrade step not run) or if PAS does not notify group events.
+    """
+    if not HAS_PAS_GROUP_EVENTS:
+        return None
+    return queryUtility(IPlonegroupGroupsMapping)
+
+
+def split_plone_group_id(plone_group_id):
+    """
+        Return (org_uid, suffix) of a suffixed Plone group id, (None, None) if not suffixed.
+        There is no '_' in organization UID so the first part is the organization UID.
+    """
+    parts = plone_group_id.split('_')
+    if len(parts) == 1:
+        return None, None
+    return parts[0], '_'.join(parts[1:])
+
+
+def get_source_groups_memberships():
+    """
+        Return the source_groups storage {principal_id: (group_ids)},
+        None if source_groups is not a ZODBGroupManager.
+    """
+    acl_users = api.portal.get_tool('acl_users')
+    source_groups = getattr(aq_base(acl_users), 'source_groups', None)
+    return getattr(source_groups, '_principal_groups', None)
+
+
+def get_principal_group_ids(principal_id):
+    """
+        Return ids of groups p_principal_id is member of, directly or through
+        nested groups, read from source_groups storage.
+    """
+    principal_groups = get_source_groups_memberships()
+    if principal_groups is None:
+        return set([group.getId() for group in api.group.get_groups(user=api.user.get(userid=principal_id))])
+    group_ids = set()
+    to_visit = [principal_id]
+    while to_visit:
+        for group_id in principal_groups.get(to_visit.pop(), ()):
+            if group_id not in group_ids:
+                group_ids.add(group_id)
+                to_visit.append(group_id)
+    return group_ids
+
+
+def rebuild_groups_mapping():
+    """
+        Register every existing Plone group using a defined suffix and their members.
+        Must be called on existing sites when the mapping is installed.
+    """
+    mapping = get_groups_mapping()
+    if mapping is None:
+        logger.warn('Plonegroup groups mapping utility is not installed!')
+        return 0
+    mapping.clear()
+    suffixes = set([function['fct_id'] for function in get_registry_functions(frozen=True)])
+    portal_groups = api.portal.get_tool('portal_groups')
+    count = 0
+    for group_id in portal_groups.getGroupIds():
+        org_uid, suffix = split_plone_group_id(group_id)
+        if suffix in suffixes:
+            mapping.add(org_uid, suffix, group_id)
+            count += 1
+    principal_groups = get_source_groups_memberships()
+    if principal_groups is not None:
+        for principal_id, group_ids in principal_groups.items():
+            for group_id in group_ids:
+                mapping.add_member(principal_id, group_id)
+    logger.info('Plonegroup groups mapping rebuilt with {0} Plone groups.'.format(count))
+    return count
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+    Group events notified by Products.PluggableAuthService >= 1.11.3, used to keep the groups mapping
+    up to date. Imported by zcml:condition, it can not be imported with older versions.
+"""
+
+from Products.PluggableAuthService.interfaces.events import IGroupCreatedEvent
+from Products.PluggableAuthService.interfaces.events import IPrincipalAddedToGroupEvent
+from Products.PluggableAuthService.interfaces.events import IPrincipalRemovedFromGroupEvent
+
+
+__all__ = ('IGroupCreatedEvent', 'IPrincipalAddedToGroupEvent', 'IPrincipalRemovedFromGroupEvent')
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+from collective.contact.plonegroup import logger
+from collective.contact.plonegroup.indexers import index_built
+from collective.contact.plonegroup.indexers import set_index_built
+from plone import api
+from plone.behavior.interfaces import IBehavior
+from plone.dexterity.interfaces import IDexterityContent
+from plone.dexterity.interfaces import IDexterityFTI
+from plone.indexer import indexer
+from Products.CMFPlone.utils import base_hasattr
+from zope.component import getUtility
+from zope.component import queryUtility
+from zope.schema import getFieldsInOrder
+from zope.schema.interfaces import IChoice
+from zope.schema.interfaces import ICollection
+from zope.schema.interfaces import IText
+
+import re
+import transaction
+
+
+# catalog index storing UIDs referenced in the fields of dexterity content
+REFERENCES_INDEX = 'plonegroup_references'
+# number of reindexed objects between two savepoints in rebuild_references_index
+REFERENCES_BATCH_SIZE = 1000
+
+UID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+# fields declared by add-ons, {portal_type: field names}
+_declared_fields = {}
+# process wide cache, {(portal_path, portal_type): (fti _p_mtime, field names)}
+_searched_fields = {}
+
+
+def declare_reference_fields(portal_type, field_names):
+    """
+        Declare the only fields of p_portal_type that can contain an organization UID,
+        an empty p_field_names means that p_portal_type never references an organization.
+        If p_field_names is None, the declaration is removed and fields are found by introspection.
+    """
+    if field_names is None:
+        _declared_fields.pop(portal_type, None)
+    else:
+        _declared_fields[portal_type] = tuple(field_names)
+    invalidate_searched_fields(portal_type)
+
+
+def _introspect_fields(fti, filter_interfaces=(IText, ICollection, IChoice)):
+    names = []
+    schemas = [fti.lookupSchema()] + [getUtility(IBehavior, behavior_id).interface
+                                      for behavior_id in fti.behaviors]
+    for schema in schemas:
+        for name, fld in getFieldsInOrder(schema):
+            for iface in filter_interfaces:
+                if iface.providedBy(fld):
+                    names.append(name)
+                    break
+    return tuple(names)
+
+
+def get_searched_fields(portal_type):
+    """
+        Return names of fields of p_portal_type (schema and behaviors) that may contain a reference,
+        the fields declared with declare_reference_fields or IText, ICollection and IChoice fields.
+        Result is cached until the FTI is modified.
+    """
+    if portal_type in _declared_fields:
+        return _declared_fields[portal_type]
+    fti = queryUtility(IDexterityFTI, name=portal_type)
+    if fti is None:
+        return ()
+    key = ('/'.join(api.portal.get().getPhysicalPath()), portal_type)
+    # _p_mtime changes when the FTI is modified by another process
+    mtime = getattr(fti, '_p_mtime', None)
+    cached = _searched_fields.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, _introspect_fields(fti))
+        _searched_fields[key] = cached
+    return cached[1]
+
+
+def get_referencing_types():
+    """
+        Return dexterity portal_types having fields that may contain a reference.
+    """
+    portal_types = api.portal.get_tool('portal_types')
+    return [fti.getId() for fti in portal_types.listTypeInfo()
+            if IDexterityFTI.providedBy(fti) and get_searched_fields(fti.getId())]
+
+
+def invalidate_searched_fields(portal_type=None):
+    """
+        Invalidate cached fields of p_portal_type, of every portal_types if None.
+    """
+    for key in list(_searched_fields.keys()):
+        if portal_type is None or key[1] == portal_type:
+            _searched_fields.pop(key, None)
+
+
+def fti_modified(fti, event):
+    """
+        Invalidate cached fields when a dexterity FTI is modified (schema, behaviors).
+    """
+    invalidate_searched_fields(fti.getId())
+
+
+def iter_values(val):
+    """
+        Walk in p_val (dict, iterable) and yield every string value.
+    """
+    if isinstance(val, dict):
+        for v in val.values():
+            for res in iter_values(v):
+                yield res
+    elif isinstance(val, basestring):
+        yield val
+    elif base_hasattr(val, '__iter__'):
+        for v in val:
+            for res in iter_values(v):
+                yield res
+
+
+def get_referenced_uids(obj):
+    """
+        Return the set of UIDs found in the searched fields of p_obj.
+    """
+    uids = set()
+    # nothing is done for portal_types never referencing an organization
+    for attr in get_searched_fields(obj.portal_type):
+        if base_hasattr(obj, attr):
+            uids.update([value for value in iter_values(getattr(obj, attr)) if UID_RE.match(value)])
+    return uids
+
+
+@indexer(IDexterityContent)
+def plonegroup_references(obj):
+    """
+        Index UIDs referenced in fields, used by search_value_in_objects to find
+        content using an organization without walking every content.
+    """
+    return tuple(sorted(get_referenced_uids(obj)))
+
+
+def references_index_built(catalog=None):
+    """
+        Return True if REFERENCES_INDEX is installed and rebuilt, an index added
+        to a site with content but not rebuilt can not be trusted, even if some contents were indexed since.
+    """
+    return index_built(REFERENCES_INDEX, catalog)
+
+
+def rebuild_references_index(batch_size=REFERENCES_BATCH_SIZE):
+    """
+        Reindex REFERENCES_INDEX for every dexterity content, a savepoint is done every p_batch_size objects.
+        Must be called on existing sites when the index is added.
+    """
+    catalog = api.portal.get_tool('portal_catalog')
+    if REFERENCES_INDEX not in catalog.indexes():
+        logger.warn('Catalog index {0} is not installed!'.format(REFERENCES_INDEX))
+        return 0
+    count = 0
+    for brain in catalog.unrestrictedSearchResults(object_provides=IDexterityContent.__identifier__):
+        obj = brain._unrestrictedGetObject()
+        catalog.catalog_object(obj, uid=brain.getPath(), idxs=[REFERENCES_INDEX], update_metadata=0)
+        count += 1
+        if count % batch_size == 0:
+            transaction.savepoint(optimistic=True)
+            catalog._p_jar.cacheGC()
+            logger.info('Plonegroup references index: {0} objects reindexed.'.format(count))
+    set_index_built(REFERENCES_INDEX, catalog=catalog)
+    logger.info('Plonegroup references index rebuilt for {0} objects.'.format(count))
+    return count
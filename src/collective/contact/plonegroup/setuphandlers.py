@@ -3,6 +3,11 @@
 from collective.contact.plonegroup import logger
 from collective.contact.plonegroup.config import FUNCTIONS_REGISTRY
 from collective.contact.plonegroup.config import ORGANIZATIONS_REGISTRY
+from collective.contact.plonegroup.indexers import full_title_index_built
+from collective.contact.plonegroup.indexers import rebuild_full_title_index
+from collective.contact.plonegroup.mapping import rebuild_groups_mapping
+from collective.contact.plonegroup.references import rebuild_references_index
+from collective.contact.plonegroup.references import references_index_built
 from plone.registry.interfaces import IRegistry
 from ZODB.POSException import ConnectionStateError
 from zope.component import getUtility
@@ -23,3 +28,10 @@ def postInstall(context):
         except ConnectionStateError:
             logger.warn('!!!Failed to set registry functions to []!!!')
             registry.records[FUNCTIONS_REGISTRY].field.value_type = None
+    # register existing Plone groups when reinstalling
+    rebuild_groups_mapping()
+    # index content existing before install
+    if not references_index_built():
+        rebuild_references_index()
+    if not full_title_index_built():
+        rebuild_full_title_index()
@@ -1,32 +1,52 @@
 # -*- coding: utf-8 -*-
 
+from Acquisition import aq_base
 from Acquisition import aq_get
+from collective.contact.core.content.organization import IOrganization
 from collective.contact.plonegroup import _
+from collective.contact.plonegroup import logger
+from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
 from collective.contact.plonegroup.config import get_registry_organizations
-from collective.contact.plonegroup.utils import get_all_suffixes
+from collective.contact.plonegroup.config import invalidate_registry_snapshot
+from collective.contact.plonegroup.config import SNAPSHOT_REGISTRIES
+from collective.contact.plonegroup.indexers import reindex_full_titles
+from collective.contact.plonegroup.mapping import get_groups_mapping
+from collective.contact.plonegroup.mapping import split_plone_group_id
+from collective.contact.plonegroup.references import get_referencing_types
+from collective.contact.plonegroup.references import get_searched_fields
+from collective.contact.plonegroup.references import references_index_built
+from collective.contact.plonegroup.references import REFERENCES_INDEX
+from collective.contact.plonegroup.references import UID_RE
+from collective.contact.plonegroup.utils import get_functions_index
+from collective.contact.plonegroup.utils import invalidate_full_titles
+from collective.contact.plonegroup.utils import invalidate_plonegroup_caches
+from collective.contact.plonegroup.utils import invalidate_plonegroup_membership_caches
+from collective.contact.plonegroup.utils import organization_title_changed
+from collective.contact.plonegroup.utils import queue_before_commit
+from collective.contact.widget.interfaces import IContactContent
 from config import PLONEGROUP_ORG
 from interfaces import INotPloneGroupContact
 from interfaces import IPloneGroupContact
 from plone import api
 from plone.app.linkintegrity.handlers import referencedObjectRemoved as baseReferencedObjectRemoved
 from plone.app.linkintegrity.interfaces import ILinkIntegrityInfo
-from plone.behavior.interfaces import IBehavior
 from plone.dexterity.interfaces import IDexterityContent
-from plone.dexterity.interfaces import IDexterityFTI
 from Products.CMFPlone.utils import base_hasattr
+from Products.DCWorkflow.interfaces import IAfterTransitionEvent
 from Products.CMFPlone.utils import safe_unicode
 from Products.statusmessages.interfaces import IStatusMessage
 from zExceptions import Redirect
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getMultiAdapter
-from zope.component import getUtility
+from zope.container.interfaces import IContainerModifiedEvent
 from zope.interface import alsoProvides
 from zope.interface import Interface
 from zope.interface import noLongerProvides
+from zope.lifecycleevent.interfaces import IObjectMovedEvent
 from zope.lifecycleevent.interfaces import IObjectRemovedEvent
-from zope.schema import getFieldsInOrder
-from zope.schema.interfaces import IChoice
-from zope.schema.interfaces import ICollection
-from zope.schema.interfaces import IText
+
+import threading
+import transaction
 
 
 try:
@@ -36,7 +56,13 @@ except ImportError:
         pass
 
 
-def search_value_in_objects(s_obj, ref, p_types=[], type_fields={}):
+# request annotation key of organizations checked by plonegroupOrganizationRemoved
+REMOVED_CHECKED_KEY = 'collective.contact.plonegroup.removed_checked'
+# number of changed objects between two savepoints in mark_organizations
+MARK_BATCH_SIZE = 500
+
+
+def search_value_in_objects(s_obj, ref, p_types=[], type_fields={}, workers=0):
     """
         Searching a value (reference to an object like id or uid) in fields of objects.
         Parameters:
@@ -45,12 +71,97 @@ def search_value_in_objects(s_obj, ref, p_types=[], type_fields={}):
             * p_types : portal_types that will be only searched
             * type_fields : dict containing as key portal_type and as value a list of fields that must be searched.
                             If a portal_type is not given, all fields will be searched
+            * workers : number of threads loading objects when every object must be searched, see
+                        search_values_in_objects
+    """
+    search_values_in_objects({ref: s_obj}, p_types=p_types, type_fields=type_fields, workers=workers)
+
+
+def _find_refs(obj, fields, refs):
+    """
+        Return the set of p_refs found in p_fields of p_obj.
+    """
+    found = set()
+
+    def check_attribute(val):
+        """ check the attribute value and walk in it """
+        if isinstance(val, dict):
+            for v in val.values():
+                check_attribute(v)
+        elif base_hasattr(val, '__iter__'):
+            for v in val:
+                check_attribute(v)
+        elif isinstance(val, basestring) and val in refs:
+            found.add(val)
+
+    for attr in fields:
+        if base_hasattr(obj, attr):
+            check_attribute(getattr(obj, attr))
+            # every searched value is referenced, no need to check other fields
+            if len(found) == len(refs):
+                break
+    return found
+
+
+def _scan_paths(db, paths, fields_by_type, refs, results, errors):
+    """
+        Worker of _parallel_scan, objects are loaded with its own connection.
+    """
+    conn = db.open()
+    try:
+        app = conn.root()['Application']
+        for i, path in enumerate(paths):
+            obj = app.unrestrictedTraverse(path, None)
+            if obj is not None:
+                found = _find_refs(obj, fields_by_type.get(obj.portal_type, ()), refs)
+                if found:
+                    results.append((path, found))
+            if i % 100 == 0:
+                conn.cacheGC()
+    except Exception as exc:
+        errors.append(exc)
+    finally:
+        transaction.abort()
+        conn.close()
+
+
+def _parallel_scan(catalog, brains, fields_by_type, refs, workers):
+    """
+        Search p_refs in objects of p_brains with p_workers threads, each using its own read only
+        ZODB connection. Objects are seen as last committed, changes of the current transaction are ignored.
+        Return a list of (object, found refs).
+    """
+    brains_by_path = dict([(brain.getPath(), brain) for brain in brains])
+    paths = brains_by_path.keys()
+    db = catalog._p_jar.db()
+    results = []
+    errors = []
+    threads = [threading.Thread(target=_scan_paths,
+                                args=(db, paths[i::workers], fields_by_type, refs, results, errors))
+               for i in xrange(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return [(brains_by_path[path]._unrestrictedGetObject(), found) for path, found in results]
+
+
+def search_values_in_objects(s_objs, p_types=[], type_fields={}, workers=0):
+    """
+        Searching values in fields of objects in one pass, see search_value_in_objects.
+        s_objs is a dict containing as key the value to search and as value the object maybe referenced.
+        A breach is stored for every referenced object.
+        When every object must be searched (no references index), if p_workers > 1 objects are loaded
+        by p_workers threads, this is useful for long running scripts on a ZEO client.
     """
     # we check all dexterity objects fields to see if ref is used in
     # we can't check only fields using plonegroup vocabulary because maybe another vocabulary name is used
     # this can be long but this operation is not made so often
-
-    request = aq_get(s_obj, 'REQUEST', None)
+    if not s_objs:
+        return
+    request = aq_get(s_objs.values()[0], 'REQUEST', None)
     if not request:
         return
     try:
@@ -60,64 +171,89 @@ def search_value_in_objects(s_obj, ref, p_types=[], type_fields={}):
         return
 
     storage = ILinkIntegrityInfo(request)
+    refs = frozenset(s_objs.keys())
 
-    def list_fields(ptype, filter_interfaces=(IText, ICollection, IChoice)):
+    def list_fields(ptype):
         """ return for the portal_type the selected fields """
-        if ptype not in type_fields:
-            type_fields[ptype] = []
-            fti = getUtility(IDexterityFTI, name=ptype)
-            for name, fld in getFieldsInOrder(fti.lookupSchema()):
-                for iface in filter_interfaces:
-                    if iface.providedBy(fld):
-                        type_fields[ptype].append(name)
-                        break
-            # also lookup behaviors
-            for behavior_id in fti.behaviors:
-                behavior = getUtility(IBehavior, behavior_id).interface
-                for name, fld in getFieldsInOrder(behavior):
-                    for iface in filter_interfaces:
-                        if iface.providedBy(fld):
-                            type_fields[ptype].append(name)
-                            break
-        return type_fields[ptype]
-
-    def check_value(val):
-        if isinstance(val, basestring) and val == ref:
-            return True
-        return False
+        if ptype in type_fields:
+            return type_fields[ptype]
+        return get_searched_fields(ptype)
 
-    def check_attribute(val):
-        """ check the attribute value and walk in it """
-        if isinstance(val, dict):
-            for v in val.values():
-                res = check_attribute(v)
-                if res:
-                    return res
-        elif base_hasattr(val, '__iter__'):
-            for v in val:
-                res = check_attribute(v)
-                if res:
-                    return res
-        elif check_value(val):
-            res = [val]
-            return res
+    if references_index_built(catalog) and not [ref for ref in refs if not UID_RE.match(ref)]:
+        # only objects referencing the uids, checked in case the index is not up to date
+        query = {REFERENCES_INDEX: list(refs)}
+        if p_types:
+            query['portal_type'] = p_types
+        brains = catalog.unrestrictedSearchResults(**query)
+        workers = 0
+    else:
+        # portal_types that can not reference anything are not searched
+        portal_types = get_referencing_types() + list(type_fields.keys())
+        if p_types:
+            portal_types = [ptype for ptype in p_types if ptype in portal_types]
+        if not portal_types:
+            return
+        brains = catalog.unrestrictedSearchResults(portal_type=portal_types,
+                                                   object_provides=IDexterityContent.__identifier__)
+    if workers > 1:
+        # fields are computed here, the site is not available in workers
+        fields_by_type = dict([(ptype, list_fields(ptype)) for ptype in portal_types])
+        results = _parallel_scan(catalog, brains, fields_by_type, refs, workers)
+    else:
+        results = []
+        for brain in brains:
+            obj = brain._unrestrictedGetObject()
+            found = _find_refs(obj, list_fields(obj.portal_type), refs)
+            if found:
+                results.append((obj, found))
+    for obj, found in results:
+        for ref in found:
+            storage.addBreach(obj, s_objs[ref])
+
+
+def _folder_delete_paths(del_obj, request):
+    """
+        Return physical paths of objects deleted with p_del_obj by a folder_delete p_request ('paths'),
+        an empty list for other requests or if p_del_obj is not one of them.
+    """
+    if not request.get('ACTUAL_URL', '').endswith('/folder_delete'):
+        return []
+    paths = request.form.get('paths') or []
+    if isinstance(paths, basestring):
+        paths = [paths]
+    portal_path = '/'.join(api.portal.get().getPhysicalPath())
+    # relative paths are traversed from the portal
+    paths = [path.startswith('/') and path or '{0}/{1}'.format(portal_path, path) for path in paths]
+    del_path = '/'.join(del_obj.getPhysicalPath())
+    if not [path for path in paths if del_path == path or del_path.startswith(path + '/')]:
         return []
+    return paths
 
-    for brain in catalog.unrestrictedSearchResults(portal_types=p_types,
-                                                   object_provides=IDexterityContent.__identifier__):
-        obj = brain._unrestrictedGetObject()
-        ptype = obj.portal_type
-        for attr in list_fields(ptype):
-            if base_hasattr(obj, attr):
-                res = check_attribute(getattr(obj, attr))
-                if res:
-                    storage.addBreach(obj, s_obj)
-                    break
+
+def _removed_organizations(del_obj, request, checked):
+    """
+        Return {uid: organization} of IPloneGroupContact removed by p_request and not p_checked yet:
+        p_del_obj, contained organizations and, when many objects are deleted at once
+        (folder_delete 'paths'), the other deleted objects and their contained organizations.
+    """
+    paths = ['/'.join(del_obj.getPhysicalPath())] + _folder_delete_paths(del_obj, request)
+    s_objs = {}
+    uid = del_obj.UID()
+    if uid not in checked:
+        s_objs[uid] = del_obj
+    catalog = api.portal.get_tool('portal_catalog')
+    for brain in catalog.unrestrictedSearchResults(path={'query': paths},
+                                                   object_provides=IPloneGroupContact.__identifier__):
+        if brain.UID not in checked and brain.UID not in s_objs:
+            s_objs[brain.UID] = brain._unrestrictedGetObject()
+    return s_objs
 
 
 def plonegroupOrganizationRemoved(del_obj, event):
     """
         Store information about the removed organization integrity.
+        Contained organizations and other organizations removed by the same request
+        are removed too, they are checked in the same pass.
     """
     # inspired from z3c/relationfield/event.py:breakRelations
     # and plone/app/linkintegrity/handlers.py:referenceRemoved
@@ -126,8 +262,18 @@ def plonegroupOrganizationRemoved(del_obj, event):
     except api.portal.CannotGetPortalError:
         # When deleting site, the portal is no more found...
         return
-    if pp.site_properties.enable_link_integrity_checks:
-        search_value_in_objects(del_obj, del_obj.UID(), p_types=[], type_fields={})
+    if not pp.site_properties.enable_link_integrity_checks:
+        return
+    request = aq_get(del_obj, 'REQUEST', None)
+    if not request:
+        return
+    # organizations already checked in this request with a removed container or sibling
+    checked = IAnnotations(request).setdefault(REMOVED_CHECKED_KEY, set())
+    if del_obj.UID() in checked:
+        return
+    s_objs = _removed_organizations(del_obj, request, checked)
+    checked.update(s_objs.keys())
+    search_values_in_objects(s_objs, p_types=[], type_fields={})
 
 
 def referencedObjectRemoved(obj, event):
@@ -143,7 +289,7 @@ def plonegroup_contact_transition(contact, event):
         # check if the transition is selected
         pp = api.portal.get_tool('portal_properties')
         errors = []
-        if contact.UID() in get_registry_organizations():
+        if contact.UID() in get_registry_organizations(frozen=True):
             errors.append(_('This contact is selected in configuration'))
         elif pp.site_properties.enable_link_integrity_checks:
             search_value_in_objects(contact, contact.UID(), p_types=[], type_fields={})
@@ -163,22 +309,151 @@ def plonegroup_contact_transition(contact, event):
             raise Redirect(view_url)
 
 
+def set_organization_markers(contact):
+    """
+        Set IPloneGroupContact on contact content under own organization, INotPloneGroupContact elsewhere.
+        Return True if provided interfaces changed.
+    """
+    if '/%s' % PLONEGROUP_ORG in contact.absolute_url_path():
+        provided, not_provided = IPloneGroupContact, INotPloneGroupContact
+    else:
+        provided, not_provided = INotPloneGroupContact, IPloneGroupContact
+    changed = False
+    if not provided.providedBy(contact):
+        alsoProvides(contact, provided)
+        changed = True
+    if not_provided.providedBy(contact):
+        noLongerProvides(contact, not_provided)
+        changed = True
+    return changed
+
+
 def mark_organization(contact, event):
     """ Set a marker interface on contact content. """
     if IObjectRemovedEvent.providedBy(event):
         return
-    if '/%s' % PLONEGROUP_ORG in contact.absolute_url_path():
-        if not IPloneGroupContact.providedBy(contact):
-            alsoProvides(contact, IPloneGroupContact)
-        if INotPloneGroupContact.providedBy(contact):
-            noLongerProvides(contact, INotPloneGroupContact)
+    # most of the time, like when adding a contact next to others, nothing changes
+    if not set_organization_markers(contact):
+        return
+    # an object added, moved and modified in the same transaction is reindexed once
+    path = contact.getPhysicalPath()
+    queue_before_commit(('reindex_object_provides', path), _reindex_object_provides, path, aq_base(contact))
+
+
+def mark_organizations(path=None, batch_size=MARK_BATCH_SIZE):
+    """
+        Set marker interfaces on every contact content, under p_path if given.
+        Only changed objects are reindexed, a savepoint is done every p_batch_size changed objects.
+        Return the number of changed objects.
+    """
+    catalog = api.portal.get_tool('portal_catalog')
+    query = {'object_provides': IContactContent.__identifier__}
+    if path:
+        query['path'] = path
+    changed = 0
+    for brain in catalog.unrestrictedSearchResults(**query):
+        obj = brain._unrestrictedGetObject()
+        if not set_organization_markers(obj):
+            continue
+        obj.reindexObject(idxs=['object_provides'])
+        changed += 1
+        if changed % batch_size == 0:
+            transaction.savepoint(optimistic=True)
+            catalog._p_jar.cacheGC()
+            logger.info('Marked {0} contacts.'.format(changed))
+    return changed
+
+
+def _reindex_object_provides(path, contact):
+    portal = api.portal.get()
+    obj = portal.unrestrictedTraverse(path, None)
+    # removed or moved since, the new path was queued too
+    if obj is None or aq_base(obj) is not contact:
+        return
+    obj.reindexObject(idxs=['object_provides'])
+
+
+def organizations_tree_changed(obj, event):
+    """
+        Invalidate plonegroup caches (organizations vocabularies, ...) when an organization or a directory
+        is added, moved, removed, modified or transitioned under the directory or own organization
+    """
+    if IOrganization.providedBy(obj):
+        if IContainerModifiedEvent.providedBy(event) or IAfterTransitionEvent.providedBy(event):
+            # sub organizations or state changed, not full titles
+            pass
+        elif IObjectMovedEvent.providedBy(event):
+            # moved contents are reindexed by Plone
+            invalidate_full_titles(obj.UID())
+        elif organization_title_changed(obj, event):
+            invalidate_full_titles(obj.UID())
+            # full titles of sub organizations are reindexed once before commit
+            queue_before_commit('reindex_full_titles', reindex_full_titles, set())[0].add(
+                '/'.join(obj.getPhysicalPath()))
+        else:
+            # modified without title change, like a phone number
+            return
+    if IObjectMovedEvent.providedBy(event):
+        paths = [parent.getPhysicalPath() + (name, )
+                 for parent, name in ((event.oldParent, event.oldName), (event.newParent, event.newName))
+                 if parent is not None]
     else:
-        if not INotPloneGroupContact.providedBy(contact):
-            alsoProvides(contact, INotPloneGroupContact)
-        if IPloneGroupContact.providedBy(contact):
-            noLongerProvides(contact, IPloneGroupContact)
+        paths = [obj.getPhysicalPath()]
+    for path in paths:
+        if DEFAULT_DIRECTORY_ID in path or PLONEGROUP_ORG in path:
+            invalidate_plonegroup_caches()
+            return
+
+
+def registry_record_changed(event):
+    """
+        Invalidate the frozen snapshot of a plonegroup registry record.
+        Subscribers registered after this one read up to date snapshots,
+        detectContactPlonegroupChange invalidates the snapshot itself.
+    """
+    record_name = getattr(event.record, '__name__', None)
+    if record_name in SNAPSHOT_REGISTRIES:
+        invalidate_registry_snapshot(record_name)
+
+
+def group_created(event):
+    """
+        Register a new Plone group using a defined suffix in the groups mapping
+    """
+    mapping = get_groups_mapping()
+    if mapping is None:
+        return
+    group_id = event.principal
+    org_uid, group_suffix = split_plone_group_id(group_id)
+    if group_suffix in get_functions_index().by_id:
+        mapping.add(org_uid, group_suffix, group_id)
 
-    contact.reindexObject(idxs='object_provides')
+
+def principal_added_to_group(event):
+    """
+        Register the new member of a Plone group using a defined suffix in the groups mapping
+    """
+    mapping = get_groups_mapping()
+    if mapping is not None and mapping.add_member(event.principal, event.group_id):
+        invalidate_plonegroup_membership_caches()
+
+
+def principal_removed_from_group(event):
+    """
+        Unregister the member of a Plone group from the groups mapping
+    """
+    mapping = get_groups_mapping()
+    if mapping is not None and mapping.remove_member(event.principal, event.group_id):
+        invalidate_plonegroup_membership_caches()
+
+
+def principal_deleted(event):
+    """
+        Unregister every memberships of a deleted principal from the groups mapping
+    """
+    mapping = get_groups_mapping()
+    if mapping is not None and mapping.remove_principal(event.principal):
+        invalidate_plonegroup_membership_caches()
 
 
 def group_deleted(event):
@@ -189,12 +464,14 @@ def group_deleted(event):
     portal = api.portal.get()
     request = portal.REQUEST
 
-    parts = group.split('_')
-    if len(parts) == 1:
+    org_uid, group_suffix = split_plone_group_id(group)
+    if org_uid is None:
         return
-    org_uid = parts[0]
-    group_suffix = '_'.join(parts[1:])
-    if org_uid in get_registry_organizations() and group_suffix in get_all_suffixes(org_uid):
+    mapping = get_groups_mapping()
+    if mapping is not None:
+        mapping.remove(group)
+    if org_uid in get_registry_organizations(frozen=True) and \
+       group_suffix in get_functions_index().get_suffixes(org_uid):
         orga = api.content.find(UID=org_uid)[0].getObject()
         api.portal.show_message(message=_("You cannot delete the group '${group}', linked to used organization "
                                           "'${orga}'.", mapping={'group': group, 'orga': safe_unicode(orga.Title())}),
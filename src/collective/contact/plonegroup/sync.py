@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from collective.contact.plonegroup import logger
+from collective.contact.plonegroup.config import get_registry_deferred_sync_threshold
+from collective.contact.plonegroup.config import get_registry_functions
+from collective.contact.plonegroup.config import get_registry_organizations
+from collective.contact.plonegroup.events import PlonegroupGroupCreatedEvent
+from collective.contact.plonegroup.mapping import get_groups_mapping
+from collective.contact.plonegroup.utils import get_full_titles
+from collective.contact.plonegroup.utils import get_not_empty_plone_groups
+from collective.contact.plonegroup.utils import get_organizations
+from collective.contact.plonegroup.utils import get_plone_group_id
+from collective.contact.plonegroup.utils import get_plone_group_title
+from collective.contact.plonegroup.utils import get_plone_groups_titles
+from collective.contact.plonegroup.utils import invalidate_plonegroup_caches
+from DateTime import DateTime
+from imio.helpers.content import safe_encode
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+from plone import api
+from uuid import uuid4
+from ZODB.POSException import ConflictError
+from zope.annotation.interfaces import IAnnotations
+from zope.event import notify
+
+import transaction
+
+
+# sync jobs are stored in the portal annotations
+SYNC_JOBS_KEY = 'collective.contact.plonegroup.sync_jobs'
+# number of operations applied between two commits by process_sync_jobs
+SYNC_JOB_CHUNK_SIZE = 100
+# number of finished (done or failed) sync jobs kept
+SYNC_JOBS_KEPT = 20
+
+
+class SyncJobError(Exception):
+    """A sync job operation can not be applied anymore."""
+
+
+class GroupsSyncPlan(object):
+    """
+        Plone groups changes computed from plonegroup configuration changes.
+        - create: {group_id: (org_uid, suffix, title)}, Plone groups to create;
+        - retitle: {group_id: (org_uid, suffix, title)}, existing Plone groups which title changed;
+        - delete: {group_id: (org_uid, suffix)}, existing Plone groups to delete;
+        - changes: True if caches must be invalidated even if no Plone group changes.
+    """
+
+    def __init__(self):
+        self.create = OrderedDict()
+        self.retitle = OrderedDict()
+        self.delete = OrderedDict()
+        self.changes = False
+
+    def __nonzero__(self):
+        return bool(self.create or self.retitle or self.delete or self.changes)
+
+    def ensure(self, org_uids, suffix, function_title):
+        """Make sure the Plone groups of p_org_uids for p_suffix exist with the right title."""
+        group_ids = [(org_uid, get_plone_group_id(org_uid, suffix)) for org_uid in org_uids]
+        # organizations are only loaded if their full title is not cached
+        org_titles = get_full_titles(org_uids, separator=' - ', first_index=1)
+        # existing groups and their title are asked at once
+        group_titles = get_plone_groups_titles(
+            [group_id for org_uid, group_id in group_ids if group_id not in self.create])
+        for org_uid, group_id in group_ids:
+            self.delete.pop(group_id, None)
+            if org_uid not in org_titles:
+                continue
+            title = get_plone_group_title(org_titles[org_uid], function_title)
+            if group_id in self.create or group_id not in group_titles:
+                self.create[group_id] = (org_uid, suffix, title)
+            elif safe_encode(group_titles[group_id] or '') != title:
+                self.retitle[group_id] = (org_uid, suffix, title)
+            else:
+                self.retitle.pop(group_id, None)
+
+    def remove(self, org_uids, suffix):
+        """Make sure the Plone groups of p_org_uids for p_suffix do not exist."""
+        group_ids = [(org_uid, get_plone_group_id(org_uid, suffix)) for org_uid in org_uids]
+        for org_uid, group_id in group_ids:
+            self.retitle.pop(group_id, None)
+        # a group planned for creation does not exist yet
+        group_ids = [(org_uid, group_id) for org_uid, group_id in group_ids
+                     if self.create.pop(group_id, None) is None and group_id not in self.delete]
+        existing = get_plone_groups_titles([group_id for org_uid, group_id in group_ids])
+        for org_uid, group_id in group_ids:
+            if group_id in existing:
+                self.delete[group_id] = (org_uid, suffix)
+
+    def __len__(self):
+        return len(self.create) + len(self.retitle) + len(self.delete)
+
+    def operations(self):
+        """Return the plan as a list of (action, group_id, org_uid, suffix, title), deletions first."""
+        return [('delete', group_id) + infos + (None, ) for group_id, infos in self.delete.items()] + \
+            [('create', group_id) + infos for group_id, infos in self.create.items()] + \
+            [('retitle', group_id) + infos for group_id, infos in self.retitle.items()]
+
+    def summary(self):
+        """Return numbers of Plone groups to create, retitle and delete."""
+        return {'create': len(self.create), 'retitle': len(self.retitle), 'delete': len(self.delete)}
+
+
+def plan_organizations_change(old_value, new_value, functions=None, plan=None):
+    """
+        Plan Plone groups changes when selected organizations change from p_old_value to p_new_value.
+        p_functions are the defined functions, current ones by default.
+    """
+    if plan is None:
+        plan = GroupsSyncPlan()
+    if functions is None:
+        functions = get_registry_functions(frozen=True)
+    old_set = set(old_value or [])
+    new_set = set(new_value or [])
+    # new organizations, keep selection order
+    added = [uid for uid in new_value or [] if uid not in old_set]
+    for fct_dic in functions:
+        if fct_dic['enabled'] is False or not added:
+            continue
+        org_uids = [org_uid for org_uid in added
+                    if not fct_dic['fct_orgs'] or org_uid in fct_dic['fct_orgs']]
+        if org_uids:
+            plan.ensure(org_uids, fct_dic['fct_id'], fct_dic['fct_title'])
+    # removed organizations, existing Plone groups are kept
+    if old_set.difference(new_set):
+        plan.changes = True
+    return plan
+
+
+def _function_changed(old_dic, new_dic):
+    """Return True if Plone groups may change from function p_old_dic to p_new_dic."""
+    return old_dic is None or \
+        old_dic['enabled'] != new_dic['enabled'] or \
+        old_dic['fct_title'] != new_dic['fct_title'] or \
+        list(old_dic['fct_orgs'] or []) != list(new_dic['fct_orgs'] or [])
+
+
+def plan_functions_change(old_value, new_value, registry_orgs=None, plan=None):
+    """
+        Plan Plone groups changes when functions change from p_old_value to p_new_value.
+        p_registry_orgs are the selected organizations, current ones by default.
+        Only new, removed and functions which enabled, fct_title or fct_orgs changed are planned.
+        Plone groups of removed functions, disabled functions or organizations no more in
+        a function fct_orgs are deleted, it is checked before that they are empty (validateSettings).
+    """
+    if plan is None:
+        plan = GroupsSyncPlan()
+    if registry_orgs is None:
+        registry_orgs = get_registry_organizations(frozen=True)
+    old_functions = dict([(fct_dic['fct_id'], fct_dic) for fct_dic in old_value or []])
+    new_ids = set([fct_dic['fct_id'] for fct_dic in new_value or []])
+    all_orgs = None
+    # removed functions
+    removed_ids = [fct_id for fct_id in old_functions if fct_id not in new_ids]
+    if removed_ids:
+        all_orgs = get_organizations(only_selected=False, the_objects=False)
+        for fct_id in removed_ids:
+            plan.remove(all_orgs, fct_id)
+    # new or changed functions
+    for fct_dic in new_value or []:
+        if not _function_changed(old_functions.get(fct_dic['fct_id']), fct_dic):
+            continue
+        fct_id = fct_dic['fct_id']
+        fct_orgs = fct_dic['fct_orgs']
+        enabled = fct_dic['enabled']
+        if not fct_orgs and enabled is True:
+            # Plone groups are created for every selected organizations
+            plan.ensure(registry_orgs, fct_id, fct_dic['fct_title'])
+        else:
+            # only Plone groups of organizations in fct_orgs are kept
+            if all_orgs is None:
+                all_orgs = get_organizations(only_selected=False, the_objects=False)
+            kept = enabled is True and [org_uid for org_uid in all_orgs if org_uid in fct_orgs] or []
+            plan.ensure(kept, fct_id, fct_dic['fct_title'])
+            plan.remove([org_uid for org_uid in all_orgs if org_uid not in kept], fct_id)
+    return plan
+
+
+def get_sync_plan(organizations=None, functions=None):
+    """
+        Dry run, return the GroupsSyncPlan that saving given p_organizations and/or p_functions
+        would execute, without changing anything.
+        Like the control panel, organizations are saved before functions.
+    """
+    plan = GroupsSyncPlan()
+    registry_orgs = get_registry_organizations(frozen=True)
+    registry_functions = get_registry_functions(frozen=True)
+    if organizations is not None:
+        plan_organizations_change(registry_orgs, organizations, functions=registry_functions, plan=plan)
+        registry_orgs = organizations
+    if functions is not None and registry_orgs:
+        plan_functions_change(registry_functions, functions, registry_orgs=registry_orgs, plan=plan)
+    return plan
+
+
+def apply_operation(operation, check=False, not_empty_groups=None):
+    """
+        Apply one operation of GroupsSyncPlan.operations.
+        If p_check, the Plone group existence is checked first so applying
+        an operation again does not fail, this is used by the sync jobs worker.
+        A Plone group that received members since the plan was computed is not deleted,
+        SyncJobError is raised. p_not_empty_groups, the not empty Plone groups among
+        deleted ones, may be given when applying many operations, they are computed otherwise.
+    """
+    action, group_id, org_uid, suffix, title = operation
+    if check:
+        exists = api.group.get(groupname=group_id) is not None
+        if action == 'delete' and not exists:
+            return
+        if action == 'delete' and not_empty_groups is None:
+            not_empty_groups = get_not_empty_plone_groups([group_id])
+        if action == 'delete' and group_id in not_empty_groups:
+            raise SyncJobError('Plone group {0} is not empty, it can not be deleted.'.format(group_id))
+        elif action != 'delete':
+            action = exists and 'retitle' or 'create'
+    if action == 'delete':
+        api.group.delete(groupname=group_id)
+        return
+    mapping = get_groups_mapping()
+    if action == 'create':
+        group = api.group.create(groupname=group_id, title=title)
+        if mapping is not None:
+            mapping.add(org_uid, suffix, group_id)
+        notify(PlonegroupGroupCreatedEvent(group))
+    else:
+        if mapping is not None:
+            mapping.add(org_uid, suffix, group_id)
+        api.portal.get_tool('portal_groups').editGroup(group_id, title=title)
+
+
+def execute_sync_plan(plan):
+    """
+        Apply p_plan, return True if something changed.
+    """
+    for operation in plan.operations():
+        apply_operation(operation)
+    return bool(plan)
+
+
+def sync_plan(plan):
+    """
+        Apply p_plan now or, when it has more operations than the deferred sync threshold,
+        store it in a sync job. Return True if caches must be invalidated.
+    """
+    threshold = get_registry_deferred_sync_threshold()
+    if threshold and len(plan) > threshold:
+        # Plone groups will be changed by the sync jobs worker
+        add_sync_job(plan)
+        return plan.changes
+    return execute_sync_plan(plan)
+
+
+def get_sync_jobs():
+    """
+        Return sync jobs, oldest first.
+    """
+    return IAnnotations(api.portal.get()).get(SYNC_JOBS_KEY, [])
+
+
+def purge_sync_jobs(kept=SYNC_JOBS_KEPT):
+    """
+        Remove finished (done or failed) sync jobs but the p_kept most recent ones.
+        Return the number of removed jobs.
+    """
+    jobs = get_sync_jobs()
+    finished = [job for job in jobs if job['status'] != 'pending']
+    removed = finished[:max(len(finished) - kept, 0)]
+    for job in removed:
+        jobs.remove(job)
+    return len(removed)
+
+
+def add_sync_job(plan):
+    """
+        Store operations of p_plan in a new sync job processed later by process_sync_jobs.
+    """
+    annotations = IAnnotations(api.portal.get())
+    if SYNC_JOBS_KEY not in annotations:
+        annotations[SYNC_JOBS_KEY] = PersistentList()
+    purge_sync_jobs()
+    job = PersistentMapping(id=uuid4().hex,
+                            created=DateTime(),
+                            operations=tuple(plan.operations()),
+                            position=0,
+                            status='pending',
+                            error=None)
+    annotations[SYNC_JOBS_KEY].append(job)
+    logger.info('Plonegroup sync job {0} added with {1} operations.'.format(job['id'], len(plan)))
+    return job
+
+
+def retry_sync_jobs():
+    """
+        Set failed sync jobs back to pending, they restart at the failing chunk,
+        operations are checked so those already applied are not applied twice.
+        Return the number of jobs to retry.
+    """
+    count = 0
+    for job in get_sync_jobs():
+        if job['status'] == 'failed':
+            job['status'] = 'pending'
+            job['error'] = None
+            count += 1
+    return count
+
+
+def process_sync_jobs(chunk_size=SYNC_JOB_CHUNK_SIZE, commit=True, retry_failed=False):
+    """
+        Apply pending sync jobs operations by chunks of p_chunk_size.
+        If p_commit, the transaction is committed after each chunk with the job position,
+        an interrupted worker restarts where it stopped.
+        Operations of a failing chunk are cancelled, the job is then marked as failed
+        and not processed anymore, unless p_retry_failed (see retry_sync_jobs).
+        The portal must be the current site, when used from 'bin/instance run', call setSite(portal) first.
+        Return the number of applied operations.
+    """
+    if retry_failed and retry_sync_jobs() and commit:
+        transaction.commit()
+    count = 0
+    for job in get_sync_jobs():
+        if job['status'] != 'pending':
+            continue
+        operations = job['operations']
+        while job['position'] < len(operations):
+            chunk = operations[job['position']:job['position'] + chunk_size]
+            savepoint = not commit and transaction.savepoint(optimistic=True)
+            try:
+                # members of deleted Plone groups are read once for the chunk
+                not_empty_groups = get_not_empty_plone_groups(
+                    [operation[1] for operation in chunk if operation[0] == 'delete'])
+                for operation in chunk:
+                    apply_operation(operation, check=True, not_empty_groups=not_empty_groups)
+            except ConflictError:
+                raise
+            except Exception as exc:
+                logger.exception('Plonegroup sync job {0} failed.'.format(job['id']))
+                if commit:
+                    transaction.abort()
+                else:
+                    savepoint.rollback()
+                job['status'] = 'failed'
+                job['error'] = repr(exc)
+                break
+            job['position'] += len(chunk)
+            count += len(chunk)
+            invalidate_plonegroup_caches()
+            logger.info('Plonegroup sync job {0}: {1}/{2} operations done.'.format(
+                job['id'], job['position'], len(operations)))
+            if commit:
+                transaction.commit()
+        else:
+            job['status'] = 'done'
+        if commit:
+            transaction.commit()
+    if purge_sync_jobs() and commit:
+        transaction.commit()
+    return count
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+""" indexers.py tests for this package."""
+
+from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
+from collective.contact.plonegroup.config import PLONEGROUP_ORG
+from collective.contact.plonegroup.indexers import FULL_TITLE_INDEX
+from collective.contact.plonegroup.indexers import full_title_index_built
+from collective.contact.plonegroup.indexers import rebuild_full_title_index
+from collective.contact.plonegroup.indexers import set_index_built
+from collective.contact.plonegroup.testing import IntegrationTestCase
+from collective.contact.plonegroup.utils import get_own_organization
+from collective.contact.plonegroup.utils import process_commit_queue
+from plone import api
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+
+
+class TestIndexers(IntegrationTestCase):
+
+    def setUp(self):
+        """Custom shared utility setup for tests."""
+        self.portal = self.layer['portal']
+        self.catalog = self.portal.portal_catalog
+        # Organizations creation
+        self.portal.invokeFactory('directory', DEFAULT_DIRECTORY_ID)
+        self.portal[DEFAULT_DIRECTORY_ID].invokeFactory('organization', PLONEGROUP_ORG, title='My organization')
+        self.own_orga = get_own_organization()
+        self.dep1 = api.content.create(
+            container=self.own_orga, type='organization', id='department1', title='Department 1')
+        self.dep2 = api.content.create(
+            container=self.own_orga, type='organization', id='department2', title='Department 2')
+        self.serv1 = api.content.create(
+            container=self.dep1, type='organization', id='service1', title='Service 1')
+
+    def full_title(self, obj):
+        rid = self.catalog(UID=obj.UID())[0].getRID()
+        return self.catalog._catalog.getIndex(FULL_TITLE_INDEX).getEntryForObject(rid)
+
+    def test_full_title_index(self):
+        self.assertTrue(FULL_TITLE_INDEX in self.catalog.indexes())
+        self.assertEqual(self.full_title(self.serv1), u'My organization / Department 1 / Service 1')
+        # title of a parent changed, sub organizations are reindexed before commit
+        self.dep1.title = u'Department 0'
+        notify(ObjectModifiedEvent(self.dep1))
+        process_commit_queue()
+        self.assertEqual(self.full_title(self.serv1), u'My organization / Department 0 / Service 1')
+        # moved, reindexed by Plone
+        api.content.move(source=self.serv1, target=self.dep2)
+        self.assertEqual(self.full_title(self.dep2['service1']), u'My organization / Department 2 / Service 1')
+        # rebuilt
+        self.catalog._catalog.getIndex(FULL_TITLE_INDEX).clear()
+        set_index_built(FULL_TITLE_INDEX, built=False)
+        self.assertIsNone(self.full_title(self.dep1))
+        self.assertFalse(full_title_index_built())
+        # an organization indexed since does not make the index trusted
+        self.dep2.reindexObject()
+        self.assertFalse(full_title_index_built())
+        self.assertTrue(rebuild_full_title_index(batch_size=1) >= 4)
+        self.assertEqual(self.full_title(self.dep1), u'My organization / Department 0')
+        self.assertTrue(full_title_index_built())
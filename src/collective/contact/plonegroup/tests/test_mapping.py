@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+""" mapping.py tests for this package."""
+
+from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
+from collective.contact.plonegroup.config import get_registry_functions
+from collective.contact.plonegroup.config import PLONEGROUP_ORG
+from collective.contact.plonegroup.config import set_registry_functions
+from collective.contact.plonegroup.config import set_registry_organizations
+from collective.contact.plonegroup.mapping import get_groups_mapping
+from collective.contact.plonegroup.mapping import rebuild_groups_mapping
+from collective.contact.plonegroup.mapping import split_plone_group_id
+from collective.contact.plonegroup.testing import IntegrationTestCase
+from collective.contact.plonegroup.utils import get_own_organization
+from collective.contact.plonegroup.utils import get_plone_group_id
+from collective.contact.plonegroup.utils import get_user_organizations
+from collective.contact.plonegroup.utils import plone_group_exists
+from plone import api
+from zExceptions import Forbidden
+
+
+class TestMapping(IntegrationTestCase):
+
+    def setUp(self):
+        """Custom shared utility setup for tests."""
+        self.portal = self.layer['portal']
+        # Organizations creation
+        self.portal.invokeFactory('directory', DEFAULT_DIRECTORY_ID)
+        self.portal[DEFAULT_DIRECTORY_ID].invokeFactory('organization', PLONEGROUP_ORG, title='My organization')
+        self.own_orga = get_own_organization()
+        self.dep1 = api.content.create(
+            container=self.own_orga, type='organization', id='department1', title='Department 1')
+        self.uid = self.dep1.UID()
+        set_registry_organizations([self.uid])
+        set_registry_functions([{'fct_title': u'Observers',
+                                 'fct_id': u'observer',
+                                 'fct_orgs': [],
+                                 'fct_management': False,
+                                 'enabled': True},
+                                {'fct_title': u'Director',
+                                 'fct_id': u'director',
+                                 'fct_orgs': [],
+                                 'fct_management': False,
+                                 'enabled': True}, ])
+        self.mapping = get_groups_mapping()
+
+    def test_split_plone_group_id(self):
+        self.assertEqual(split_plone_group_id('abc'), (None, None))
+        self.assertEqual(split_plone_group_id('abc_suffix'), ('abc', 'suffix'))
+        self.assertEqual(split_plone_group_id('abc_my_suffix'), ('abc', 'my_suffix'))
+
+    def test_mapping_maintained(self):
+        observer_id = get_plone_group_id(self.uid, 'observer')
+        director_id = get_plone_group_id(self.uid, 'director')
+        self.assertEqual(self.mapping.get_group_ids(self.uid),
+                         {u'observer': observer_id, u'director': director_id})
+        self.assertEqual(self.mapping.get_group_id(self.uid, u'director'), director_id)
+        self.assertEqual(self.mapping.get_org_and_suffix(director_id), (self.uid, u'director'))
+        self.assertTrue(plone_group_exists(director_id))
+        # removing a function deletes the Plone groups
+        functions = get_registry_functions()
+        functions.pop(1)
+        set_registry_functions(functions)
+        self.assertFalse(director_id in self.mapping)
+        self.assertIsNone(self.mapping.get_group_id(self.uid, u'director'))
+        self.assertEqual(self.mapping.get_group_ids(self.uid), {u'observer': observer_id})
+        # groups not using a defined suffix are not mapped
+        api.group.create(groupname='%s_other' % self.uid)
+        self.assertFalse('%s_other' % self.uid in self.mapping)
+        self.assertTrue(plone_group_exists('%s_other' % self.uid))
+        self.assertFalse(plone_group_exists('unknown_observer'))
+        # groups missing in the mapping (other PAS plugin, mapping not rebuilt) are asked to PAS
+        observer_id = get_plone_group_id(self.uid, u'observer')
+        self.mapping.remove(observer_id)
+        self.assertTrue(plone_group_exists(observer_id))
+
+    def test_rebuild_groups_mapping(self):
+        observer_id = get_plone_group_id(self.uid, 'observer')
+        self.mapping.clear()
+        self.assertFalse(observer_id in self.mapping)
+        self.assertEqual(rebuild_groups_mapping(), 2)
+        self.assertEqual(self.mapping.get_org_and_suffix(observer_id), (self.uid, u'observer'))
+        # the view only rebuilds on POST with an authenticator
+        self.mapping.clear()
+        request = self.portal.REQUEST
+        request.environ['REQUEST_METHOD'] = 'POST'
+        view = self.portal.restrictedTraverse('@@rebuild-plonegroup-groups-mapping')
+        self.assertRaises(Forbidden, view)
+        self.assertFalse(observer_id in self.mapping)
+        request.form['_authenticator'] = self.portal.restrictedTraverse('@@authenticator').token()
+        view()
+        self.assertTrue(observer_id in self.mapping)
+
+    def test_memberships(self):
+        observer_id = get_plone_group_id(self.uid, 'observer')
+        director_id = get_plone_group_id(self.uid, 'director')
+        api.user.create(email='test@test.be', username='user1')
+        self.assertEqual(get_user_organizations('user1', ['observer']), set())
+        api.group.add_user(groupname=observer_id, username='user1')
+        self.assertEqual(self.mapping.get_principal_orgs('user1', u'observer'), frozenset([self.uid]))
+        self.assertEqual(get_user_organizations('user1', ['observer']), set([self.uid]))
+        self.assertEqual(get_user_organizations('user1', ['director']), set())
+        # nested groups
+        api.group.create(groupname='nested')
+        api.group.add_user(groupname='nested', username='user1')
+        api.group.add_user(groupname=director_id, username='nested')
+        self.assertEqual(get_user_organizations('user1', ['director', 'observer']), set([self.uid]))
+        # only selected organizations
+        set_registry_organizations([self.own_orga.UID()])
+        self.assertEqual(get_user_organizations('user1', ['observer']), set())
+        self.assertEqual(get_user_organizations('user1', ['observer'], only_selected=False), set([self.uid]))
+        # removed from group
+        api.group.remove_user(groupname=observer_id, username='user1')
+        self.assertEqual(self.mapping.get_principal_orgs('user1', u'observer'), frozenset())
+        # rebuilt
+        self.mapping.clear()
+        rebuild_groups_mapping()
+        self.assertEqual(self.mapping.get_principal_orgs('nested', u'director'), frozenset([self.uid]))
+        # deleted principal
+        api.group.delete(groupname='nested')
+        self.assertFalse('nested' in self.mapping.memberships)
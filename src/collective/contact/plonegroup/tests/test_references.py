@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+""" references.py tests for this package."""
+
+from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
+from collective.contact.plonegroup.config import PLONEGROUP_ORG
+from collective.contact.plonegroup.indexers import set_index_built
+from collective.contact.plonegroup.references import declare_reference_fields
+from collective.contact.plonegroup.references import get_referenced_uids
+from collective.contact.plonegroup.references import get_referencing_types
+from collective.contact.plonegroup.references import get_searched_fields
+from collective.contact.plonegroup.references import rebuild_references_index
+from collective.contact.plonegroup.references import REFERENCES_INDEX
+from collective.contact.plonegroup.references import references_index_built
+from collective.contact.plonegroup.subscribers import search_value_in_objects
+from collective.contact.plonegroup.testing import IntegrationTestCase
+from collective.contact.plonegroup.utils import get_own_organization
+from plone import api
+from plone.app.linkintegrity.interfaces import ILinkIntegrityInfo
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+
+
+class TestReferences(IntegrationTestCase):
+
+    def setUp(self):
+        """Custom shared utility setup for tests."""
+        self.portal = self.layer['portal']
+        self.catalog = self.portal.portal_catalog
+        # Organizations creation
+        self.portal.invokeFactory('directory', DEFAULT_DIRECTORY_ID)
+        self.portal[DEFAULT_DIRECTORY_ID].invokeFactory('organization', PLONEGROUP_ORG, title='My organization')
+        self.dep1 = api.content.create(
+            container=get_own_organization(), type='organization', id='department1', title='Department 1')
+        self.uid = self.dep1.UID()
+        self.portal.invokeFactory('acontent', 'acontent1', title='Content 1', pg_organization=self.uid)
+        self.portal.invokeFactory('acontent', 'acontent2', title='Content 2')
+
+    def test_references_index(self):
+        self.assertTrue(REFERENCES_INDEX in self.catalog.indexes())
+        self.assertEqual(get_referenced_uids(self.portal['acontent1']), set([self.uid]))
+        self.assertEqual(get_referenced_uids(self.portal['acontent2']), set())
+        self.assertEqual([b.id for b in self.catalog(**{REFERENCES_INDEX: self.uid})], ['acontent1'])
+        # values in dict and list
+        self.portal['acontent2'].pg_organization = [{'uid': self.uid}, 'not a uid']
+        self.portal['acontent2'].reindexObject()
+        self.assertEqual(sorted([b.id for b in self.catalog(**{REFERENCES_INDEX: self.uid})]),
+                         ['acontent1', 'acontent2'])
+        # rebuilt
+        self.catalog._catalog.getIndex(REFERENCES_INDEX).clear()
+        self.assertFalse(self.catalog(**{REFERENCES_INDEX: self.uid}))
+        self.assertTrue(rebuild_references_index(batch_size=1) >= 2)
+        self.assertEqual(len(self.catalog(**{REFERENCES_INDEX: self.uid})), 2)
+
+    def test_search_value_in_objects(self):
+        storage = ILinkIntegrityInfo(self.portal.REQUEST)
+        # value changed without reindex, found objects are checked
+        self.portal['acontent1'].pg_organization = None
+        search_value_in_objects(self.dep1, self.uid)
+        self.assertNotIn(self.dep1, storage.getIntegrityBreaches())
+        self.portal['acontent1'].pg_organization = self.uid
+        search_value_in_objects(self.dep1, self.uid)
+        self.assertEqual(storage.getIntegrityBreaches()[self.dep1], set([self.portal['acontent1']]))
+
+    def test_search_value_in_objects_index_not_built(self):
+        # index added to a site with content but not rebuilt, every content is scanned
+        self.catalog._catalog.getIndex(REFERENCES_INDEX).clear()
+        set_index_built(REFERENCES_INDEX, built=False)
+        self.assertFalse(references_index_built())
+        # a content indexed since does not make the index trusted
+        self.portal['acontent2'].reindexObject()
+        self.assertFalse(references_index_built())
+        storage = ILinkIntegrityInfo(self.portal.REQUEST)
+        search_value_in_objects(self.dep1, self.uid)
+        self.assertEqual(storage.getIntegrityBreaches()[self.dep1], set([self.portal['acontent1']]))
+        rebuild_references_index()
+        self.assertTrue(references_index_built())
+
+    def test_get_searched_fields(self):
+        self.assertIn('pg_organization', get_searched_fields('acontent'))
+        self.assertIn('acontent', get_referencing_types())
+        self.assertEqual(get_searched_fields('unknown'), ())
+        # cached until the FTI is modified
+        fti = self.portal.portal_types.acontent
+        self.assertTrue(get_searched_fields('acontent') is get_searched_fields('acontent'))
+        behaviors = fti.behaviors
+        self.assertIn('description', get_searched_fields('acontent'))
+        fti.behaviors = tuple([behavior for behavior in behaviors if not behavior.endswith('IBasic')])
+        notify(ObjectModifiedEvent(fti))
+        self.assertNotIn('description', get_searched_fields('acontent'))
+        fti.behaviors = behaviors
+        notify(ObjectModifiedEvent(fti))
+        # declared fields
+        declare_reference_fields('acontent', ['pg_organization'])
+        self.assertEqual(get_searched_fields('acontent'), ('pg_organization', ))
+        declare_reference_fields('acontent', [])
+        self.assertNotIn('acontent', get_referencing_types())
+        self.assertEqual(get_referenced_uids(self.portal['acontent1']), set())
+        declare_reference_fields('acontent', None)
+        self.assertIn('acontent', get_referencing_types())
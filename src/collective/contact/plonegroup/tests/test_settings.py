@@ -6,21 +6,34 @@ from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
 from collective.contact.plonegroup.config import PLONEGROUP_ORG
 from collective.contact.plonegroup.config import get_registry_functions
 from collective.contact.plonegroup.config import get_registry_organizations
+from collective.contact.plonegroup.config import ORGANIZATIONS_REGISTRY
 from collective.contact.plonegroup.config import set_registry_functions
 from collective.contact.plonegroup.config import set_registry_organizations
 from collective.contact.plonegroup.testing import IntegrationTestCase
 from collective.contact.plonegroup.utils import get_own_organization
 from collective.contact.plonegroup.utils import get_plone_group_id
+from collective.contact.plonegroup.utils import process_commit_queue
 from plone import api
 from plone.app.testing import TEST_USER_ID
+from plone.registry.events import RecordModifiedEvent
 from z3c.form import validator
 from zExceptions import Redirect
 from zope import event
 from zope.component import getUtility
 from zope.i18n import translate
 from zope.interface import Invalid
+from zope.interface import Interface
+from zope.lifecycleevent import Attributes
 from zope.lifecycleevent import ObjectModifiedEvent
 from zope.schema.interfaces import IVocabularyFactory
+from zope.schema.vocabulary import SimpleTerm
+
+
+class FullTitleVocabulary(settings.OwnOrganizationServicesVocabulary):
+    """Vocabulary overriding a method receiving organizations."""
+
+    def _term_title(self, orga, parent_label):
+        return orga.get_full_title(first_index=1)
 
 
 class TestSettings(IntegrationTestCase):
@@ -61,6 +74,28 @@ class TestSettings(IntegrationTestCase):
         voc_list = [voc_dic[key].title for key in voc_dic.keys()]
         self.assertSetEqual(set(voc_list), set(['Department 1 - Service 1', 'Department 1', 'Department 2']))
         self.assertNotIn('Inactive department', voc_list)
+        # terms are ordered as the tree, children after their parent
+        self.assertEqual([term.title for term in services(self)],
+                         [u'Department 1', u'Department 1 - Service 1', u'Department 2'])
+        # sub organizations of an inactive organization are not listed
+        own_orga = get_own_organization()
+        own_orga['inactive_department'].invokeFactory('organization', 'service2', title='Service 2')
+        self.assertEqual(len(services(self)), 3)
+        # vocabulary is cached, invalidated when an organization is modified
+        self.assertEqual(services._get_terms('organization', PLONEGROUP_ORG),
+                         services._get_terms('organization', PLONEGROUP_ORG))
+        own_orga['department2'].title = u'Department 2 modified'
+        own_orga['department2'].reindexObject()
+        event.notify(ObjectModifiedEvent(own_orga['department2']))
+        self.assertIn(u'Department 2 modified', [term.title for term in services(self)])
+        # returned vocabulary may be changed without changing the cache
+        del services(self).by_value[own_orga['department2'].UID()]
+        self.assertEqual(len(services(self).by_value), 3)
+        # subclasses overriding methods receiving objects still work
+        self.assertFalse(services._uses_object_hooks())
+        self.assertTrue(FullTitleVocabulary()._uses_object_hooks())
+        self.assertEqual([term.title for term in FullTitleVocabulary()(self)],
+                         [u'Department 1', u'Department 1 / Service 1', u'Department 2 modified'])
         # When multiple own organizations
         self.portal[DEFAULT_DIRECTORY_ID].invokeFactory('organization', 'temporary', title='Temporary')
         self.portal[DEFAULT_DIRECTORY_ID]['temporary'].invokeFactory(
@@ -161,6 +196,14 @@ class TestSettings(IntegrationTestCase):
         # the linked Plone groups are deleted
         self.assertFalse(api.group.get(plone_group_id))
 
+    def test_detectContactPlonegroupChangeInvalidatesSnapshot(self):
+        """The registry snapshot is invalidated whatever the order of subscribers."""
+        snapshot = get_registry_organizations(frozen=True)
+        record = api.portal.get_tool('portal_registry').records[ORGANIZATIONS_REGISTRY]
+        settings.detectContactPlonegroupChange(RecordModifiedEvent(record, snapshot, snapshot))
+        self.assertIsNot(get_registry_organizations(frozen=True), snapshot)
+        self.assertEqual(get_registry_organizations(frozen=True), snapshot)
+
     def test_detectContactPlonegroupChangeSelectOrgs(self):
         """When selecting 'fct_orgs' on a function, Plone groups are create/deleted depending
            on the fact that 'fct_orgs' is empty or contains some organization uids."""
@@ -267,6 +310,34 @@ class TestSettings(IntegrationTestCase):
         api.group.remove_user(groupname=plone_group_id, username=TEST_USER_ID)
         self.assertFalse(invariants.validate(data))
 
+    def test_validateSettingsDisableFunctionWithFctOrgs(self):
+        """A function having 'fct_orgs' may only be disabled if its Plone groups are empty,
+           stored 'fct_orgs' (tuple in the frozen snapshot) are compared with form values (list)."""
+        own_orga = get_own_organization()
+        dep1 = own_orga['department1']
+        functions = get_registry_functions()
+        functions[0]['fct_orgs'] = [dep1.UID()]
+        set_registry_functions(functions)
+        plone_group_id = get_plone_group_id(dep1.UID(), 'director')
+        api.group.add_user(groupname=plone_group_id, username=TEST_USER_ID)
+        invariants = validator.InvariantsValidator(
+            None, None, None, settings.IContactPlonegroupConfig, None)
+        functions = get_registry_functions()
+        data = {'organizations': get_registry_organizations(), 'functions': functions}
+        self.assertFalse(invariants.validate(data))
+        # disable 'director', fct_orgs are unchanged
+        functions[0]['enabled'] = False
+        errors = invariants.validate(data)
+        self.assertTrue(isinstance(errors[0], Invalid))
+        error_msg = translate(
+            msgid=u"can_not_disable_suffix_plone_groups_not_empty",
+            domain='collective.contact.plonegroup',
+            mapping={'disabled_function': 'director',
+                     'plone_group_id': plone_group_id})
+        self.assertEqual(translate(errors[0].message), error_msg)
+        # Plone group is kept as long as it is not empty
+        self.assertTrue(api.group.get(plone_group_id))
+
     def test_validateSettingsSelectFunctionOrgsOnExistingFunction(self):
         """Selecting 'fct_orgs' for an existing function (so for which Plone groups are already created),
            is only possible if groups that will be deleted (Plone groups of organizations not selected
@@ -296,6 +367,14 @@ class TestSettings(IntegrationTestCase):
         # remove user from plone group, now it validates
         api.group.remove_user(groupname=plone_group_id, username=TEST_USER_ID)
         self.assertFalse(invariants.validate(data))
+        # a new function with 'fct_orgs' and an unchanged 'fct_orgs' are valid
+        functions.append({'fct_title': u'New', 'fct_id': u'new', 'fct_orgs': [dep1.UID()],
+                          'fct_management': False, 'enabled': True})
+        self.assertFalse(invariants.validate(data))
+        set_registry_functions(functions)
+        api.group.add_user(groupname=get_plone_group_id(dep2.UID(), 'worker'), username=TEST_USER_ID)
+        functions[1]['fct_title'] = u'Workers renamed'
+        self.assertFalse(invariants.validate(data))
 
     def test_adaptPloneGroupDefinition(self):
         """ Test event when an organization is changed """
@@ -304,14 +383,31 @@ class TestSettings(IntegrationTestCase):
         # an organization is modified
         own_orga['department1'].title = 'Department 1 changed'
         event.notify(ObjectModifiedEvent(own_orga['department1']))
+        # Plone groups are updated before commit
+        d1_d_group = api.group.get(groupname='%s_director' % organizations[0])
+        self.assertEquals(d1_d_group.getProperty('title'), 'Department 1 (Director)')
+        process_commit_queue()
         d1_d_group = api.group.get(groupname='%s_director' % organizations[0])
         self.assertEquals(d1_d_group.getProperty('title'), 'Department 1 changed (Director)')
         d1s1_d_group = api.group.get(groupname='%s_director' % organizations[1])
         self.assertEquals(d1s1_d_group.getProperty('title'), 'Department 1 changed - Service 1 (Director)')
+        # edited fields not containing the title are ignored
+        own_orga['department1'].title = 'Department 1 not saved'
+        event.notify(ObjectModifiedEvent(own_orga['department1'], Attributes(Interface, 'phone')))
+        process_commit_queue()
+        d1_d_group = api.group.get(groupname='%s_director' % organizations[0])
+        self.assertEquals(d1_d_group.getProperty('title'), 'Department 1 changed (Director)')
+        event.notify(ObjectModifiedEvent(own_orga['department1'], Attributes(Interface, 'IBasic.title')))
+        process_commit_queue()
+        d1_d_group = api.group.get(groupname='%s_director' % organizations[0])
+        self.assertEquals(d1_d_group.getProperty('title'), 'Department 1 not saved (Director)')
+        own_orga['department1'].title = 'Department 1 changed'
+        event.notify(ObjectModifiedEvent(own_orga['department1']))
         # an organization is moved (service1 in department2)
         clipboard = own_orga['department1'].manage_cutObjects(['service1'])
         own_orga['department2'].manage_pasteObjects(clipboard)
         # the event IObjectMovedEvent is triggered
+        process_commit_queue()
         d1s1_d_group = api.group.get(groupname='%s_director' % organizations[1])
         self.assertEquals(d1s1_d_group.getProperty('title'), 'Department 2 - Service 1 (Director)')
         # a configured organization is deleted. Exception raised
@@ -361,6 +457,26 @@ class TestSettings(IntegrationTestCase):
         self.assertListEqual([v.title for v in settings.selectedOrganizationsVocabulary()],
                              ['Department 1', 'Department 1 - Service 1', 'Department 2'])
 
+    def test_SearchableSimpleVocabulary(self):
+        terms = [SimpleTerm(u'1', title=u'D\xe9partement 1'),
+                 SimpleTerm(u'2', title=u'D\xe9partement 1 - Service 1'),
+                 SimpleTerm(u'3', title=u'Service d\xe9p\xf4t'),
+                 SimpleTerm(u'4', title=u'Direction g\xe9n\xe9rale')]
+        vocab = settings.SearchableSimpleVocabulary(terms)
+        # accents and case are ignored, words prefixes are matched, title starting with query first
+        self.assertEqual([term.value for term in vocab.search('dep')], [u'1', u'2', u'3'])
+        self.assertEqual([term.value for term in vocab.search('SERV')], [u'3', u'2'])
+        self.assertEqual([term.value for term in vocab.search(u'd\xe9part serv')], [u'2'])
+        self.assertEqual([term.value for term in vocab.search('dep', limit=2)], [u'1', u'2'])
+        self.assertEqual(vocab.search('artement'), [])
+        self.assertEqual(len(vocab.search('')), 4)
+        # organization services vocabulary is searchable, its index is cached with the terms
+        services = getUtility(IVocabularyFactory, name=u'collective.contact.plonegroup.organization_services')
+        vocab = services(self.portal)
+        self.assertTrue(isinstance(vocab, settings.SearchableSimpleVocabulary))
+        self.assertIs(vocab._search_index, services(self.portal)._search_index)
+        self.assertEqual([term.title for term in vocab.search('serv')], [u'Department 1 - Service 1'])
+
     def test_SelectedOrganizationsElephantVocabulary(self):
         """ Test elephant vocabulary """
         factory_all = getUtility(
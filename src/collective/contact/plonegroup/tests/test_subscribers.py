@@ -7,14 +7,26 @@ from collective.contact.plonegroup.config import set_registry_functions
 from collective.contact.plonegroup.config import set_registry_organizations
 from collective.contact.plonegroup.interfaces import INotPloneGroupContact
 from collective.contact.plonegroup.interfaces import IPloneGroupContact
+from collective.contact.plonegroup.references import REFERENCES_INDEX
 from collective.contact.plonegroup.subscribers import group_deleted
+from collective.contact.plonegroup.subscribers import mark_organizations
+from collective.contact.plonegroup.subscribers import REMOVED_CHECKED_KEY
+from collective.contact.plonegroup.subscribers import search_value_in_objects
+from collective.contact.plonegroup.subscribers import set_organization_markers
+from collective.contact.plonegroup.testing import FunctionalTestCase
 from collective.contact.plonegroup.testing import IntegrationTestCase
 from collective.contact.plonegroup.utils import get_own_organization
+from collective.contact.plonegroup.utils import process_commit_queue
 from plone import api
 from plone.app.linkintegrity.exceptions import LinkIntegrityNotificationException
 from plone.app.linkintegrity.interfaces import ILinkIntegrityInfo
 from Products.statusmessages.interfaces import IStatusMessage
 from zExceptions import Redirect
+from zope.annotation.interfaces import IAnnotations
+from zope.interface import alsoProvides
+from zope.interface import noLongerProvides
+
+import transaction
 
 
 class TestSubscribers(IntegrationTestCase):
@@ -96,6 +108,37 @@ class TestSubscribers(IntegrationTestCase):
         self.assertIn(self.contacts[1], breaches)
         self.assertSetEqual(breaches[self.contacts[1]], set([self.portal['acontent2']]))
 
+    def test_plonegroupOrganizationRemoved_5(self):
+        """ Contained organizations are checked in the same pass """
+        service = api.content.create(container=self.contacts[0], type='organization', id='service1')
+        self.portal['acontent2'].pg_organization = service.UID()
+        self.portal['acontent2'].reindexObject()
+        view = self.portal.restrictedTraverse(
+            '{0}/{1}/department1/delete_confirmation'.format(DEFAULT_DIRECTORY_ID, PLONEGROUP_ORG))
+        self.assertRaises(LinkIntegrityNotificationException, view.render)
+        breaches = ILinkIntegrityInfo(view.REQUEST).getIntegrityBreaches()
+        self.assertSetEqual(breaches[self.contacts[0]], set([self.portal['acontent1']]))
+        self.assertSetEqual(breaches[service], set([self.portal['acontent2']]))
+
+    def test_plonegroupOrganizationRemoved_6(self):
+        """ Organizations deleted by the same request (folder_delete) are checked in one pass """
+        request = self.portal.REQUEST
+        request.form['paths'] = ['/'.join(contact.getPhysicalPath()) for contact in self.contacts]
+        view = self.portal.restrictedTraverse(
+            '{0}/{1}/department1/delete_confirmation'.format(DEFAULT_DIRECTORY_ID, PLONEGROUP_ORG))
+        # paths are only used by folder_delete
+        self.assertRaises(LinkIntegrityNotificationException, view.render)
+        self.assertEqual(IAnnotations(request)[REMOVED_CHECKED_KEY], set([self.contacts[0].UID()]))
+        self.assertNotIn(self.contacts[1], ILinkIntegrityInfo(request).getIntegrityBreaches())
+        del IAnnotations(request)[REMOVED_CHECKED_KEY]
+        request.set('ACTUAL_URL', '{0}/folder_delete'.format(self.portal.absolute_url()))
+        self.assertRaises(LinkIntegrityNotificationException, view.render)
+        self.assertEqual(IAnnotations(request)[REMOVED_CHECKED_KEY],
+                         set([contact.UID() for contact in self.contacts]))
+        breaches = ILinkIntegrityInfo(request).getIntegrityBreaches()
+        self.assertSetEqual(breaches[self.contacts[0]], set([self.portal['acontent1']]))
+        self.assertSetEqual(breaches[self.contacts[1]], set([self.portal['acontent2']]))
+
     def test_plonegroup_contact_transition_1(self):
         """ We cannot deactivate an organization selected in settings """
         self.assertRaises(Redirect, api.content.transition, obj=self.contacts[0], transition='deactivate')
@@ -135,6 +178,23 @@ class TestSubscribers(IntegrationTestCase):
         api.content.move(source=pg_org['department1'], target=contacts)
         self.assertTrue(INotPloneGroupContact.providedBy(contacts['department1']))
         self.assertFalse(IPloneGroupContact.providedBy(contacts['department1']))
+        # catalog is updated once before commit
+        catalog = api.portal.get_tool('portal_catalog')
+        process_commit_queue()
+        self.assertEqual([b.getObject() for b in catalog(object_provides=INotPloneGroupContact.__identifier__,
+                                                         id='department1')],
+                         [contacts['department1']])
+
+    def test_mark_organizations(self):
+        contacts = self.portal.get(DEFAULT_DIRECTORY_ID)
+        # markers are already right
+        self.assertFalse(set_organization_markers(self.contacts[0]))
+        self.assertEqual(mark_organizations(), 0)
+        noLongerProvides(self.contacts[0], IPloneGroupContact)
+        alsoProvides(self.contacts[0], INotPloneGroupContact)
+        self.assertEqual(mark_organizations(path='/'.join(contacts.getPhysicalPath()), batch_size=1), 1)
+        self.assertTrue(IPloneGroupContact.providedBy(self.contacts[0]))
+        self.assertFalse(INotPloneGroupContact.providedBy(self.contacts[0]))
 
     def test_group_deleted(self):
         class Dummy(object):
@@ -152,3 +212,22 @@ class TestSubscribers(IntegrationTestCase):
         api.group.create(groupname='12345_director')
         api.group.delete(groupname='%s_other' % uid)
         api.group.delete(groupname='12345_director')
+
+
+class TestParallelScan(FunctionalTestCase):
+    """Test search_values_in_objects with workers, objects must be committed."""
+
+    def test_search_value_in_objects_workers(self):
+        portal = self.layer['portal']
+        portal.invokeFactory('directory', DEFAULT_DIRECTORY_ID)
+        portal[DEFAULT_DIRECTORY_ID].invokeFactory('organization', PLONEGROUP_ORG, title='My organization')
+        org = get_own_organization()
+        for i in range(5):
+            portal.invokeFactory('acontent', 'acontent{0}'.format(i), title='Content',
+                                 pg_organization=i % 2 and org.UID() or None)
+        # every object is searched without the references index
+        portal.portal_catalog.delIndex(REFERENCES_INDEX)
+        transaction.commit()
+        search_value_in_objects(org, org.UID(), workers=3)
+        breaches = ILinkIntegrityInfo(portal.REQUEST).getIntegrityBreaches()
+        self.assertSetEqual(breaches[org], set([portal['acontent1'], portal['acontent3']]))
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+""" sync.py tests for this package."""
+
+from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
+from collective.contact.plonegroup.config import DEFERRED_SYNC_REGISTRY
+from collective.contact.plonegroup.config import get_registry_functions
+from collective.contact.plonegroup.config import PLONEGROUP_ORG
+from collective.contact.plonegroup.config import set_registry_functions
+from collective.contact.plonegroup.config import set_registry_organizations
+from collective.contact.plonegroup.sync import add_sync_job
+from collective.contact.plonegroup.sync import execute_sync_plan
+from collective.contact.plonegroup.sync import get_sync_jobs
+from collective.contact.plonegroup.sync import get_sync_plan
+from collective.contact.plonegroup.sync import GroupsSyncPlan
+from collective.contact.plonegroup.sync import process_sync_jobs
+from collective.contact.plonegroup.sync import purge_sync_jobs
+from collective.contact.plonegroup.sync import SYNC_JOBS_KEPT
+from collective.contact.plonegroup.testing import IntegrationTestCase
+from collective.contact.plonegroup.utils import get_own_organization
+from collective.contact.plonegroup.utils import get_plone_group
+from collective.contact.plonegroup.utils import get_plone_group_id
+from plone import api
+from plone.app.testing import TEST_USER_ID
+
+
+class TestSync(IntegrationTestCase):
+
+    def setUp(self):
+        """Custom shared utility setup for tests."""
+        self.portal = self.layer['portal']
+        # Organizations creation
+        self.portal.invokeFactory('directory', DEFAULT_DIRECTORY_ID)
+        self.portal[DEFAULT_DIRECTORY_ID].invokeFactory('organization', PLONEGROUP_ORG, title='My organization')
+        self.own_orga = get_own_organization()
+        self.dep1 = api.content.create(
+            container=self.own_orga, type='organization', id='department1', title='Department 1')
+        self.dep2 = api.content.create(
+            container=self.own_orga, type='organization', id='department2', title='Department 2')
+        self.uid1 = self.dep1.UID()
+        self.uid2 = self.dep2.UID()
+        set_registry_organizations([self.uid1])
+        set_registry_functions([{'fct_title': u'Observers',
+                                 'fct_id': u'observer',
+                                 'fct_orgs': [],
+                                 'fct_management': False,
+                                 'enabled': True}, ])
+
+    def test_get_sync_plan(self):
+        functions = get_registry_functions()
+        functions.append({'fct_title': u'Director',
+                          'fct_id': u'director',
+                          'fct_orgs': [],
+                          'fct_management': False,
+                          'enabled': True})
+        # dry run, nothing is changed
+        plan = get_sync_plan(organizations=[self.uid1, self.uid2], functions=functions)
+        self.assertEqual(plan.create.keys(),
+                         [get_plone_group_id(self.uid2, u'observer'),
+                          get_plone_group_id(self.uid1, u'director'),
+                          get_plone_group_id(self.uid2, u'director')])
+        self.assertEqual(plan.create[get_plone_group_id(self.uid2, u'observer')],
+                         (self.uid2, u'observer', 'Department 2 (Observers)'))
+        self.assertEqual(plan.summary(), {'create': 3, 'retitle': 0, 'delete': 0})
+        self.assertIsNone(get_plone_group(self.uid2, u'observer'))
+        self.assertTrue(execute_sync_plan(plan))
+        self.assertTrue(get_plone_group(self.uid2, u'director'))
+        # retitle and delete
+        functions = get_registry_functions()
+        functions[0]['fct_title'] = u'Observers modified'
+        functions[0]['fct_orgs'] = [self.uid1]
+        plan = get_sync_plan(functions=functions)
+        self.assertEqual(plan.retitle.keys(), [get_plone_group_id(self.uid1, u'observer')])
+        self.assertEqual(plan.delete.keys(), [get_plone_group_id(self.uid2, u'observer')])
+        self.assertFalse(get_sync_plan(functions=get_registry_functions()))
+
+    def test_get_sync_plan_changed_functions_only(self):
+        functions = get_registry_functions()
+        functions.append({'fct_title': u'Director',
+                          'fct_id': u'director',
+                          'fct_orgs': [],
+                          'fct_management': False,
+                          'enabled': True})
+        set_registry_functions(functions)
+        # unchanged functions are not planned, even if a Plone group is missing
+        self.portal.acl_users.source_groups.removeGroup(get_plone_group_id(self.uid1, u'observer'))
+        functions = get_registry_functions()
+        functions[1]['fct_title'] = u'Directors'
+        functions[0]['fct_management'] = True
+        plan = get_sync_plan(functions=functions)
+        self.assertEqual(plan.create.keys(), [])
+        self.assertEqual(plan.retitle.keys(), [get_plone_group_id(self.uid1, u'director')])
+        self.assertEqual(plan.retitle.values()[0][2], 'Department 1 (Directors)')
+
+    def test_detectContactPlonegroupChange_uses_plan(self):
+        set_registry_organizations([self.uid1, self.uid2])
+        self.assertEqual(get_plone_group(self.uid2, u'observer').getProperty('title'),
+                         'Department 2 (Observers)')
+        functions = get_registry_functions()
+        functions[0]['enabled'] = False
+        set_registry_functions(functions)
+        self.assertIsNone(get_plone_group(self.uid1, u'observer'))
+        self.assertIsNone(get_plone_group(self.uid2, u'observer'))
+
+    def test_deferred_sync(self):
+        api.portal.set_registry_record(DEFERRED_SYNC_REGISTRY, 1)
+        # 1 change is applied right now
+        set_registry_organizations([self.uid1, self.uid2])
+        self.assertTrue(get_plone_group(self.uid2, u'observer'))
+        self.assertEqual(get_sync_jobs(), [])
+        # 2 changes are deferred
+        functions = get_registry_functions()
+        functions.append({'fct_title': u'Director',
+                          'fct_id': u'director',
+                          'fct_orgs': [],
+                          'fct_management': False,
+                          'enabled': True})
+        set_registry_functions(functions)
+        self.assertIsNone(get_plone_group(self.uid1, u'director'))
+        job = get_sync_jobs()[0]
+        self.assertEqual(job['status'], 'pending')
+        self.assertEqual(len(job['operations']), 2)
+        # processed by chunks, an interrupted job restarts where it stopped
+        job['operations'] = (('create', u'unknown_director', u'unknown', u'director', 'Unknown (Director)'), ) + \
+            job['operations']
+        job['position'] = 1
+        self.assertEqual(process_sync_jobs(chunk_size=1, commit=False), 2)
+        self.assertEqual(job['status'], 'done')
+        self.assertIsNone(api.group.get(u'unknown_director'))
+        self.assertTrue(get_plone_group(self.uid1, u'director'))
+        self.assertTrue(get_plone_group(self.uid2, u'director'))
+        # applying again an operation does not fail
+        job['position'] = 0
+        job['status'] = 'pending'
+        self.assertEqual(process_sync_jobs(commit=False), 3)
+        self.assertEqual(job['status'], 'done')
+        self.assertTrue(api.group.get(u'unknown_director'))
+
+    def test_deferred_sync_delete_not_empty(self):
+        set_registry_organizations([self.uid1, self.uid2])
+        api.portal.set_registry_record(DEFERRED_SYNC_REGISTRY, 1)
+        functions = get_registry_functions()
+        functions[0]['enabled'] = False
+        set_registry_functions(functions)
+        job = get_sync_jobs()[0]
+        self.assertEqual([operation[0] for operation in job['operations']], ['delete', 'delete'])
+        # a member was added since the job was created, the group is not deleted
+        group_id = job['operations'][1][1]
+        api.group.add_user(groupname=group_id, username=TEST_USER_ID)
+        self.assertEqual(process_sync_jobs(chunk_size=1, commit=False), 1)
+        self.assertEqual(job['status'], 'failed')
+        self.assertTrue('SyncJobError' in job['error'])
+        self.assertEqual(job['position'], 1)
+        self.assertTrue(api.group.get(group_id))
+
+    def test_deferred_sync_failed_chunk_cancelled(self):
+        set_registry_organizations([self.uid1, self.uid2])
+        api.portal.set_registry_record(DEFERRED_SYNC_REGISTRY, 1)
+        functions = get_registry_functions()
+        functions[0]['enabled'] = False
+        set_registry_functions(functions)
+        job = get_sync_jobs()[0]
+        group_ids = [operation[1] for operation in job['operations']]
+        api.group.add_user(groupname=group_ids[1], username=TEST_USER_ID)
+        # the first deletion of the failing chunk is cancelled
+        self.assertEqual(process_sync_jobs(chunk_size=2, commit=False), 0)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['position'], 0)
+        self.assertTrue(api.group.get(group_ids[0]))
+        # failed jobs are only processed again when retried
+        api.group.remove_user(groupname=group_ids[1], username=TEST_USER_ID)
+        self.assertEqual(process_sync_jobs(commit=False), 0)
+        self.assertEqual(process_sync_jobs(commit=False, retry_failed=True), 2)
+        self.assertEqual(job['status'], 'done')
+        self.assertIsNone(job['error'])
+        self.assertIsNone(api.group.get(group_ids[1]))
+
+    def test_purge_sync_jobs(self):
+        for i in range(3):
+            add_sync_job(GroupsSyncPlan())['status'] = 'done'
+        pending = add_sync_job(GroupsSyncPlan())
+        self.assertEqual(len(get_sync_jobs()), 4)
+        # pending jobs are kept
+        self.assertEqual(purge_sync_jobs(kept=1), 2)
+        self.assertEqual([job['status'] for job in get_sync_jobs()], ['done', 'pending'])
+        self.assertEqual(get_sync_jobs()[1]['id'], pending['id'])
+        # finished jobs are purged when a job is added
+        for i in range(SYNC_JOBS_KEPT + 1):
+            add_sync_job(GroupsSyncPlan())['status'] = 'failed'
+        add_sync_job(GroupsSyncPlan())
+        self.assertEqual(len(get_sync_jobs()), SYNC_JOBS_KEPT + 2)
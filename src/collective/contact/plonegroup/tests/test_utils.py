@@ -2,12 +2,22 @@
 """ utils.py tests for this package."""
 
 from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
+from collective.contact.plonegroup.config import DEFERRED_SYNC_REGISTRY
+from collective.contact.plonegroup.config import FrozenDict
 from collective.contact.plonegroup.config import get_registry_functions
+from collective.contact.plonegroup.config import get_registry_organizations
 from collective.contact.plonegroup.config import PLONEGROUP_ORG
 from collective.contact.plonegroup.config import set_registry_functions
 from collective.contact.plonegroup.config import set_registry_organizations
+from collective.contact.plonegroup.sync import get_sync_jobs
 from collective.contact.plonegroup.testing import IntegrationTestCase
+from collective.contact.plonegroup.utils import _bump_plonegroup_generation
 from collective.contact.plonegroup.utils import get_all_suffixes
+from collective.contact.plonegroup.utils import get_full_title
+from collective.contact.plonegroup.utils import get_full_titles
+from collective.contact.plonegroup.utils import get_functions_index
+from collective.contact.plonegroup.utils import get_group_member_counts
+from collective.contact.plonegroup.utils import get_not_empty_plone_groups
 from collective.contact.plonegroup.utils import get_organization
 from collective.contact.plonegroup.utils import get_organizations
 from collective.contact.plonegroup.utils import get_own_organization
@@ -15,8 +25,15 @@ from collective.contact.plonegroup.utils import get_own_organization_path
 from collective.contact.plonegroup.utils import get_plone_group
 from collective.contact.plonegroup.utils import get_plone_group_id
 from collective.contact.plonegroup.utils import get_plone_groups
+from collective.contact.plonegroup.utils import get_plonegroup_generation
+from collective.contact.plonegroup.utils import get_plonegroup_membership_generation
 from collective.contact.plonegroup.utils import get_selected_org_suffix_users
+from collective.contact.plonegroup.utils import invalidate_plonegroup_caches
+from collective.contact.plonegroup.utils import organization_title_changed
 from collective.contact.plonegroup.utils import organizations_with_suffixes
+from collective.contact.plonegroup.utils import plonegroup_batch
+from collective.contact.plonegroup.utils import process_commit_queue
+from collective.contact.plonegroup.utils import queue_before_commit
 from collective.contact.plonegroup.utils import select_org_for_function
 from collective.contact.plonegroup.utils import select_organization
 from collective.contact.plonegroup.utils import voc_selected_org_suffix_users
@@ -25,6 +42,8 @@ from plone.app.testing import TEST_USER_ID
 from plone.app.testing import TEST_USER_NAME
 from plone.registry.interfaces import IRegistry
 from zope.component import getUtility
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
 
 
 class TestUtils(IntegrationTestCase):
@@ -55,6 +74,27 @@ class TestUtils(IntegrationTestCase):
                                  'enabled': True}, ])
         api.group.add_user(groupname='%s_director' % self.uid, username=TEST_USER_ID)
 
+    def test_get_registry_snapshot(self):
+        functions = get_registry_functions(frozen=True)
+        self.assertTrue(isinstance(functions, tuple))
+        self.assertTrue(isinstance(functions[0], FrozenDict))
+        self.assertTrue(isinstance(functions[0]['fct_orgs'], tuple))
+        self.assertRaises(TypeError, functions[0].__setitem__, 'enabled', False)
+        # same snapshot is returned until registry is modified
+        self.assertIs(get_registry_functions(frozen=True), functions)
+        self.assertEqual(get_registry_organizations(frozen=True), (self.uid, ))
+        # as_copy returns a mutable copy
+        copied = get_registry_functions()
+        self.assertEqual(copied, [dict(fct) for fct in functions])
+        copied[0]['fct_orgs'].append(self.uid)
+        self.assertEqual(get_registry_functions(frozen=True)[0]['fct_orgs'], ())
+        # modifying the registry invalidates the snapshot
+        set_registry_functions(copied)
+        self.assertIsNot(get_registry_functions(frozen=True), functions)
+        self.assertEqual(get_registry_functions(frozen=True)[0]['fct_orgs'], (self.uid, ))
+        set_registry_organizations([self.uid, self.dep2.UID()])
+        self.assertEqual(get_registry_organizations(frozen=True), (self.uid, self.dep2.UID()))
+
     def test_organizations_with_suffixes(self):
         class Dum(object):
             def __init__(self, id):
@@ -132,6 +172,31 @@ class TestUtils(IntegrationTestCase):
         self.assertEqual(get_organizations(not_empty_suffix=u'director'), [self.dep1])
         self.assertEqual(get_organizations(not_empty_suffix=u'observer'), [])
 
+    def test_get_not_empty_plone_groups(self):
+        director_id = get_plone_group_id(self.uid, 'director')
+        observer_id = get_plone_group_id(self.uid, 'observer')
+        self.assertEqual(get_not_empty_plone_groups([]), set())
+        self.assertEqual(get_not_empty_plone_groups([director_id, observer_id, 'unknown_director']),
+                         set([director_id]))
+        # '<not found>' members
+        source_groups = self.portal.acl_users.source_groups
+        source_groups.addPrincipalToGroup('unknown_user', observer_id)
+        self.assertEqual(get_not_empty_plone_groups([director_id, observer_id]),
+                         set([director_id, observer_id]))
+        self.assertEqual(get_not_empty_plone_groups([director_id, observer_id], ignore_not_found=True),
+                         set([director_id]))
+
+    def test_get_group_member_counts(self):
+        director_id = get_plone_group_id(self.uid, 'director')
+        observer_id = get_plone_group_id(self.uid, 'observer')
+        self.assertEqual(get_group_member_counts([]), {})
+        self.assertEqual(get_group_member_counts([director_id, observer_id, 'unknown_director']),
+                         {director_id: 1, observer_id: 0, 'unknown_director': 0})
+        api.user.create(email='test@test.be', username='user2')
+        api.group.add_user(groupname=director_id, username='user2')
+        api.group.add_user(groupname=observer_id, username='user2')
+        self.assertEqual(get_group_member_counts([director_id, observer_id]), {director_id: 2, observer_id: 1})
+
     def test_get_organizations_follows_selected_organizations_order(self):
         self.assertEqual(get_organizations(only_selected=True), [self.dep1])
         select_organization(self.dep2.UID())
@@ -180,6 +245,27 @@ class TestUtils(IntegrationTestCase):
         self.assertEqual(get_all_suffixes(dep2_uid, only_enabled=True), [u'director'])
         self.assertEqual(get_all_suffixes(dep2_uid, only_enabled=False), [u'observer', u'director'])
 
+    def test_get_functions_index(self):
+        dep2_uid = self.dep2.UID()
+        index = get_functions_index()
+        self.assertIs(get_functions_index(), index)
+        self.assertEqual(index.get_suffixes(), (u'observer', u'director'))
+        self.assertEqual(index.unrestricted[True], (u'observer', u'director'))
+        self.assertEqual(index.by_org[True], {})
+        self.assertEqual(index.by_id[u'director']['fct_title'], u'Director')
+        # index is rebuilt when functions are changed
+        functions = get_registry_functions()
+        functions[0]['fct_orgs'] = [self.uid]
+        functions[1]['enabled'] = False
+        set_registry_functions(functions)
+        index = get_functions_index()
+        self.assertEqual(index.unrestricted[True], ())
+        self.assertEqual(index.unrestricted[False], (u'director', ))
+        self.assertEqual(index.get_suffixes(self.uid), (u'observer', ))
+        self.assertEqual(index.get_suffixes(self.uid, only_enabled=False), (u'observer', u'director'))
+        self.assertEqual(index.get_suffixes(dep2_uid), ())
+        self.assertEqual(index.get_suffixes(dep2_uid, only_enabled=False), (u'director', ))
+
     def test_get_own_organization_path(self):
         """ Test the returned organization path """
         self.assertEqual(get_own_organization(default=True), self.portal[DEFAULT_DIRECTORY_ID][PLONEGROUP_ORG])
@@ -211,3 +297,109 @@ class TestUtils(IntegrationTestCase):
         self.assertTrue(self.uid in get_registry_functions()[1]['fct_orgs'])
         select_org_for_function(self.uid, 'director', remove=True)
         self.assertFalse(self.uid in get_registry_functions()[1]['fct_orgs'])
+
+    def test_plonegroup_batch(self):
+        dep2_uid = self.dep2.UID()
+        dep3 = api.content.create(
+            container=self.own_orga, type='organization', id='department3', title='Department 3')
+        dep3_uid = dep3.UID()
+        functions = get_registry_functions()
+        functions[1]['fct_orgs'] = [self.uid]
+        set_registry_functions(functions)
+        with plonegroup_batch() as batch:
+            select_organization(dep2_uid)
+            select_organization(dep3_uid)
+            select_org_for_function(dep2_uid, 'director')
+            # nothing written for now
+            self.assertEqual(get_registry_organizations(), [self.uid])
+            self.assertEqual(batch.organizations, [self.uid, dep2_uid, dep3_uid])
+            self.assertEqual(batch.functions[1]['fct_orgs'], [self.uid, dep2_uid])
+            self.assertIsNone(get_plone_group(dep2_uid, 'observer'))
+        self.assertEqual(get_registry_organizations(), [self.uid, dep2_uid, dep3_uid])
+        self.assertEqual(get_registry_functions()[1]['fct_orgs'], [self.uid, dep2_uid])
+        self.assertTrue(get_plone_group(dep2_uid, 'observer'))
+        self.assertTrue(get_plone_group(dep2_uid, 'director'))
+        self.assertTrue(get_plone_group(dep3_uid, 'observer'))
+        self.assertIsNone(get_plone_group(dep3_uid, 'director'))
+        # nothing is written if an error occurs
+        with self.assertRaises(ValueError):
+            with plonegroup_batch():
+                select_organization(dep3_uid, remove=True)
+                raise ValueError
+        self.assertEqual(get_registry_organizations(), [self.uid, dep2_uid, dep3_uid])
+        # both records changes are synchronized in one plan
+        api.portal.set_registry_record(DEFERRED_SYNC_REGISTRY, 1)
+        with plonegroup_batch():
+            select_organization(dep3_uid, remove=True)
+            select_org_for_function(dep2_uid, 'director', remove=True)
+        self.assertEqual(len(get_sync_jobs()), 1)
+        self.assertSetEqual(set([operation[1] for operation in get_sync_jobs()[0]['operations']]),
+                            set([get_plone_group_id(dep2_uid, 'director'), get_plone_group_id(dep3_uid, 'observer')]))
+
+    def test_plonegroup_generation(self):
+        generation = get_plonegroup_generation()
+        self.assertEqual(get_plonegroup_generation(), generation)
+        invalidate_plonegroup_caches()
+        pending_generation = get_plonegroup_generation()
+        self.assertNotEqual(pending_generation, generation)
+        # stored generation is only changed at commit
+        self.assertEqual(pending_generation[0], generation[0])
+        invalidate_plonegroup_caches()
+        self.assertNotEqual(get_plonegroup_generation(), pending_generation)
+        # a plonegroup change invalidates caches
+        generation = get_plonegroup_generation()
+        select_organization(self.dep2.UID())
+        self.assertNotEqual(get_plonegroup_generation(), generation)
+        # before commit hook
+        _bump_plonegroup_generation()
+        generation = get_plonegroup_generation()
+        self.assertIsNone(generation[1])
+        self.assertNotEqual(generation[0], pending_generation[0])
+        # Plone groups members changes only invalidate the membership generation
+        membership_generation = get_plonegroup_membership_generation()
+        api.group.add_user(groupname=get_plone_group_id(self.dep2.UID(), 'observer'), username=TEST_USER_ID)
+        self.assertEqual(get_plonegroup_generation(), generation)
+        self.assertNotEqual(get_plonegroup_membership_generation(), membership_generation)
+
+    def test_get_full_titles(self):
+        service = api.content.create(
+            container=self.dep1, type='organization', id='service1', title='Service 1')
+        self.assertEqual(get_full_title(service, separator=' - ', first_index=1), u'Department 1 - Service 1')
+        self.assertEqual(get_full_titles([self.uid, service.UID(), self.dep2.UID()]),
+                         {self.uid: u'My organization / Department 1',
+                          service.UID(): u'My organization / Department 1 / Service 1',
+                          self.dep2.UID(): u'My organization / Department 2'})
+        # renaming a parent invalidates the sub organizations
+        self.dep1.title = u'Department 1 renamed'
+        notify(ObjectModifiedEvent(self.dep1))
+        self.assertEqual(get_full_titles([service.UID()], separator=' - ', first_index=1),
+                         {service.UID(): u'Department 1 renamed - Service 1'})
+        # Plone group title is updated
+        process_commit_queue()
+        self.assertEqual(get_plone_group(self.uid, 'director').getProperty('title'),
+                         'Department 1 renamed (Director)')
+        # the full title cached before the modified event is not trusted, Plone groups titles are compared
+        self.dep1.title = u'Department 1 renamed again'
+        get_full_title(self.dep1, separator=' - ', first_index=1)
+        self.assertTrue(organization_title_changed(self.dep1, ObjectModifiedEvent(self.dep1)))
+        notify(ObjectModifiedEvent(self.dep1))
+        process_commit_queue()
+        self.assertEqual(get_plone_group(self.uid, 'director').getProperty('title'),
+                         'Department 1 renamed again (Director)')
+        self.assertFalse(organization_title_changed(self.dep1, ObjectModifiedEvent(self.dep1)))
+        # moving too
+        api.content.move(source=service, target=self.dep2)
+        self.assertEqual(get_full_title(service), u'My organization / Department 2 / Service 1')
+
+    def test_queue_before_commit(self):
+        calls = []
+        self.assertEqual(queue_before_commit('key1', calls.append, 'first'), ('first', ))
+        self.assertEqual(queue_before_commit('key1', calls.append, 'second'), ('first', ))
+        queue_before_commit('key2', lambda values: calls.append(sorted(values)), set())[0].add('a')
+        queue_before_commit('key2', None, None)[0].add('b')
+        self.assertEqual(calls, [])
+        process_commit_queue()
+        self.assertEqual(calls, ['first', ['a', 'b']])
+        # queue is empty
+        process_commit_queue()
+        self.assertEqual(calls, ['first', ['a', 'b']])
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """ utils.py tests for this package."""
 
+from collective.contact.plonegroup.browser.tables import PloneGroupUsersGroupsColumn
+from collective.contact.plonegroup.browser.tables import SubOrganizationsTableView
 from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
 from collective.contact.plonegroup.config import get_registry_functions
 from collective.contact.plonegroup.config import PLONEGROUP_ORG
@@ -9,12 +11,15 @@ from collective.contact.plonegroup.config import set_registry_groups_mgt
 from collective.contact.plonegroup.config import set_registry_organizations
 from collective.contact.plonegroup.testing import IntegrationTestCase
 from collective.contact.plonegroup.utils import get_own_organization
+from collective.contact.plonegroup.utils import get_plone_group_id
 from plone import api
 from plone.app.testing import TEST_USER_ID
 from plone.registry.interfaces import IRegistry
 from zExceptions import Redirect
 from zope.component import getUtility
 
+import json
+
 
 class TestViews(IntegrationTestCase):
 
@@ -122,3 +127,61 @@ class TestViews(IntegrationTestCase):
                 '_old_values_': content._old_values_}
         view.widgets.extract = lambda *a, **kw: (data, [])
         self.assertRaises(Redirect, view.handleApply, view, 'apply')
+
+    def test_suborganizations_view(self):
+        api.content.create(container=self.dep1, type='organization', id='service1', title='A service')
+        view = SubOrganizationsTableView(self.own_orga, self.portal.REQUEST)
+        view.update()
+        # sorted on full title by the catalog, context is not listed
+        self.assertEqual([brain.id for brain in view.table.results], ['department1', 'service1', 'department2'])
+        self.assertEqual(view.table.batchSize, 50)
+        # batched
+        view.table.batchSize = view.table.startBatchingAt = 2
+        view.table.update()
+        self.assertEqual(len(view.table.rows), 2)
+        # members are only counted for selected organizations of the batch
+        set_registry_organizations([self.uid, self.dep2.UID()])
+        column = [col for col in view.table.columns if isinstance(col, PloneGroupUsersGroupsColumn)][0]
+        self.assertEqual(sorted(column.member_counts.keys()),
+                         sorted([get_plone_group_id(self.uid, u'observer'), get_plone_group_id(self.uid, u'director')]))
+        # function title is escaped
+        functions = get_registry_functions()
+        functions[0]['fct_title'] = u'Observers <b>'
+        set_registry_functions(functions)
+        cell = column.renderCell(view.table.results[0])
+        self.assertIn(u'Observers &lt;b&gt;: 0', cell)
+        self.assertNotIn(u'<b>', cell)
+
+    def test_display_group_users_view(self):
+        observer_id = get_plone_group_id(self.uid, u'observer')
+        api.group.add_user(groupname=observer_id, username=u'dexter')
+        api.group.add_user(groupname=observer_id, username=u'investigators')
+        api.group.add_user(groupname=u'investigators', username=u'debra')
+        api.group.add_user(groupname=u'investigators', username=u'dexter')
+        # a cycle in nested groups
+        api.group.add_user(groupname=u'investigators', username=u'technicians')
+        api.group.add_user(groupname=u'technicians', username=u'investigators')
+        view = self.portal.restrictedTraverse('@@display-group-users')
+        observer = api.group.get(observer_id)
+        self.assertEqual(sorted([(index, principal.getId()) for index, principal
+                                 in view._get_groups_and_members(observer)]),
+                         [(0, u'dexter'), (1, u'debra')])
+        self.assertEqual(sorted([(index, principal.getId()) for index, principal
+                                 in view._get_groups_and_members(observer, keep_subgroups=True)]),
+                         [(0, u'dexter'), (1, u'investigators'), (2, u'debra'), (2, u'dexter'),
+                          (3, u'technicians')])
+        self.assertTrue(view('{0}*'.format(self.uid)))
+
+    def test_display_groups_users_json_view(self):
+        observer_id = get_plone_group_id(self.uid, u'observer')
+        director_id = get_plone_group_id(self.uid, u'director')
+        api.group.add_user(groupname=observer_id, username=u'dexter')
+        api.group.add_user(groupname=director_id, username=u'dexter')
+        api.group.add_user(groupname=u'investigators', username=u'debra')
+        view = self.portal.restrictedTraverse('@@display-groups-users-json')
+        res = json.loads(view(group_ids='investigators', org_uids=[self.uid]))
+        self.assertEqual(sorted(res['groups'].keys()), sorted([u'investigators', observer_id, director_id]))
+        self.assertEqual(res['groups'][observer_id]['members'], [[0, u'dexter']])
+        self.assertEqual(res['groups'][director_id]['members'], [[0, u'dexter']])
+        self.assertEqual(res['principals'], {u'dexter': [u'Dexter Morgan', False],
+                                             u'debra': [u'Debra Morgan', False]})
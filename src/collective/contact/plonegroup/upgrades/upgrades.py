@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 from collective.contact.plonegroup.config import FUNCTIONS_REGISTRY
-from collective.contact.plonegroup.config import PLONEGROUP_ORG
-from collective.contact.plonegroup.interfaces import INotPloneGroupContact
-from collective.contact.plonegroup.interfaces import IPloneGroupContact
+from collective.contact.plonegroup.indexers import rebuild_full_title_index
+from collective.contact.plonegroup.mapping import rebuild_groups_mapping
+from collective.contact.plonegroup.references import rebuild_references_index
+from collective.contact.plonegroup.subscribers import mark_organizations
 from plone import api
 from plone.app.uuid.utils import uuidToObject
-from zope.interface import alsoProvides
 
 import logging
 
@@ -14,17 +14,7 @@ logger = logging.getLogger('collective.contact.plonegroup: upgrade. ')
 
 
 def v2(context):
-    catalog = api.portal.get_tool('portal_catalog')
-    brains = catalog.searchResults({'object_provides': 'collective.contact.widget.interfaces.IContactContent'})
-    for brain in brains:
-        obj = brain.getObject()
-        if '/%s' % PLONEGROUP_ORG in obj.absolute_url_path():
-            if not IPloneGroupContact.providedBy(obj):
-                alsoProvides(obj, IPloneGroupContact)
-        elif not INotPloneGroupContact.providedBy(obj):
-            alsoProvides(obj, INotPloneGroupContact)
-
-        obj.reindexObject(idxs='object_provides')
+    mark_organizations()
     setup = api.portal.get_tool('portal_setup')
     setup.runImportStepFromProfile('profile-collective.contact.plonegroup:default', 'jsregistry')
 
@@ -93,3 +83,14 @@ def v7(context):
     setup = api.portal.get_tool('portal_setup')
     setup.runImportStepFromProfile('profile-collective.contact.plonegroup:default', 'plone.app.registry')
     setup.runImportStepFromProfile('profile-collective.contact.plonegroup:default', 'actions')
+
+
+def v8(context):
+    logger.info("Migrate to v8")
+    setup = api.portal.get_tool('portal_setup')
+    setup.runImportStepFromProfile('profile-collective.contact.plonegroup:default', 'componentregistry')
+    setup.runImportStepFromProfile('profile-collective.contact.plonegroup:default', 'plone.app.registry')
+    setup.runImportStepFromProfile('profile-collective.contact.plonegroup:default', 'catalog')
+    rebuild_groups_mapping()
+    rebuild_references_index()
+    rebuild_full_title_index()
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
 from collective.contact.plonegroup.config import get_registry_functions
 from collective.contact.plonegroup.config import get_registry_organizations
 from collective.contact.plonegroup.config import PLONEGROUP_ORG
 from collective.contact.plonegroup.config import set_registry_functions
 from collective.contact.plonegroup.config import set_registry_organizations
+from collective.contact.plonegroup.mapping import get_groups_mapping
+from collective.contact.plonegroup.mapping import get_principal_group_ids
+from collective.contact.plonegroup.mapping import get_source_groups_memberships
+from contextlib import contextmanager
+from imio.helpers.cache import get_cachekey_volatile
+from imio.helpers.cache import invalidate_cachekey_volatile_for
+from imio.helpers.content import safe_encode
 from imio.helpers.content import uuidsToObjects
 from operator import attrgetter
 from operator import methodcaller
@@ -13,6 +21,7 @@ from plone import api
 from plone.api.exc import GroupNotFoundError
 from plone.app.uuid.utils import uuidToObject
 from Products.CMFPlone.utils import base_hasattr
+from uuid import uuid4
 from zope.annotation.interfaces import IAnnotations
 from zope.component import getUtility
 from zope.globalrequest import getRequest
@@ -20,6 +29,121 @@ from zope.schema.interfaces import IVocabularyFactory
 from zope.schema.vocabulary import SimpleTerm
 from zope.schema.vocabulary import SimpleVocabulary
 
+import threading
+import transaction
+
+
+PLONEGROUP_GENERATION = 'collective.contact.plonegroup.generation'
+PLONEGROUP_MEMBERSHIP_GENERATION = 'collective.contact.plonegroup.membership_generation'
+
+# pending invalidations of the current transaction, {generation name: (transaction, token, counter)}
+_generation_state = threading.local()
+
+
+def _get_generation(name):
+    generation = get_cachekey_volatile(name)
+    pending = getattr(_generation_state, 'pending', {}).get(name)
+    if pending is None or pending[0] is not transaction.get():
+        return (generation, None, 0)
+    # changes not committed yet are only visible in this transaction
+    return (generation, pending[1], pending[2])
+
+
+def _bump_generation(name):
+    getattr(_generation_state, 'pending', {}).pop(name, None)
+    # stored now, in the committing transaction, not by the next (maybe GET) request reading it
+    invalidate_cachekey_volatile_for(name, get_again=True)
+
+
+def _invalidate_generation(name):
+    """
+        The stored generation is changed once when the transaction is committed,
+        until then a generation only known by the current transaction is used.
+    """
+    txn = transaction.get()
+    if not hasattr(_generation_state, 'pending'):
+        _generation_state.pending = {}
+    pending = _generation_state.pending.get(name)
+    if pending is None or pending[0] is not txn:
+        pending = (txn, uuid4().hex, 0)
+        txn.addBeforeCommitHook(_bump_generation, args=(name, ))
+    _generation_state.pending[name] = (txn, pending[1], pending[2] + 1)
+
+
+def get_plonegroup_generation():
+    """
+        Return the plonegroup generation, every cache built on plonegroup data (configuration,
+        organizations, Plone groups) should use it in its cache key, add-ons included.
+        It changes when invalidate_plonegroup_caches is called.
+        It does not change when Plone groups members change, see get_plonegroup_membership_generation.
+    """
+    return _get_generation(PLONEGROUP_GENERATION)
+
+
+def _bump_plonegroup_generation():
+    _bump_generation(PLONEGROUP_GENERATION)
+
+
+def invalidate_plonegroup_caches():
+    """
+        Invalidate every cache using get_plonegroup_generation, changed once when the transaction is committed.
+    """
+    _invalidate_generation(PLONEGROUP_GENERATION)
+
+
+def get_plonegroup_membership_generation():
+    """
+        Return the plonegroup membership generation, caches built on members of
+        plonegroup Plone groups should use it in their cache key with get_plonegroup_generation.
+        It changes when invalidate_plonegroup_membership_caches is called.
+    """
+    return _get_generation(PLONEGROUP_MEMBERSHIP_GENERATION)
+
+
+def invalidate_plonegroup_membership_caches():
+    """
+        Invalidate every cache using get_plonegroup_membership_generation,
+        changed once when the transaction is committed.
+    """
+    _invalidate_generation(PLONEGROUP_MEMBERSHIP_GENERATION)
+
+
+# work queued until the current transaction is committed, (transaction, {key: (func, args)})
+_commit_queue_state = threading.local()
+
+
+def queue_before_commit(key, func, *args):
+    """
+        Call func(*args) once before the current transaction is committed, whatever the number
+        of times p_key is queued. Queuing again a p_key keeps the first func and args.
+        Return the queued args, so mutable args can be used to collect values.
+    """
+    txn = transaction.get()
+    state = getattr(_commit_queue_state, 'queue', None)
+    if state is None or state[0] is not txn:
+        state = (txn, OrderedDict())
+        _commit_queue_state.queue = state
+        txn.addBeforeCommitHook(process_commit_queue)
+    queue = state[1]
+    if key not in queue:
+        queue[key] = (func, args)
+    return queue[key][1]
+
+
+def process_commit_queue():
+    """
+        Call now the work queued by queue_before_commit in the current transaction, in queue order.
+        It is done before commit but can be called when the result is needed sooner.
+    """
+    state = getattr(_commit_queue_state, 'queue', None)
+    if state is None or state[0] is not transaction.get():
+        return
+    queue = state[1]
+    # queued work can queue other work
+    while queue:
+        func, args = queue.popitem(last=False)[1]
+        func(*args)
+
 
 def organizations_with_suffixes(groups, suffixes, group_as_str=False):
     """
@@ -55,6 +179,105 @@ def get_plone_group(prefix, suffix):
     return plone_group
 
 
+def plone_group_exists(plone_group_id):
+    """
+        Check if a Plone group exists.
+        Groups registered in the groups mapping are not loaded, others are asked to PAS as
+        they may be created by another plugin (LDAP) or before the mapping was built.
+    """
+    mapping = get_groups_mapping()
+    if mapping is not None and plone_group_id in mapping:
+        return True
+    return api.group.get(plone_group_id) is not None
+
+
+def get_plone_group_title(organization_title, function_title):
+    """
+        Return the title of the Plone group of an organization for a function.
+    """
+    return '%s (%s)' % (safe_encode(organization_title), safe_encode(function_title))
+
+
+def get_plone_groups_titles(plone_group_ids):
+    """
+        Return {plone_group_id: title} for given p_plone_group_ids that exist,
+        asked at once to the group enumeration plugins (ZODB, LDAP, ...).
+    """
+    plone_group_ids = set(plone_group_ids)
+    if not plone_group_ids:
+        return {}
+    acl_users = api.portal.get_tool('acl_users')
+    titles = {}
+    for info in acl_users.searchGroups(id=list(plone_group_ids), exact_match=True):
+        if info['id'] in plone_group_ids and info['id'] not in titles:
+            titles[info['id']] = info.get('title')
+    return titles
+
+
+def _get_direct_members(plone_group_ids):
+    """
+        Return {plone_group_id: [member ids]} for given set of p_plone_group_ids having members,
+        read in one pass over the source_groups storage.
+    """
+    principal_groups = get_source_groups_memberships()
+    members = {}
+    if principal_groups is None:
+        # not a ZODBGroupManager, ask every group
+        for plone_group_id in plone_group_ids:
+            plone_group = api.group.get(plone_group_id)
+            if plone_group is not None:
+                members[plone_group_id] = plone_group.getMemberIds()
+    else:
+        for principal_id, principal_group_ids in principal_groups.items():
+            for plone_group_id in principal_group_ids:
+                if plone_group_id in plone_group_ids:
+                    members.setdefault(plone_group_id, []).append(principal_id)
+    return members
+
+
+def get_group_member_counts(plone_group_ids):
+    """
+        Return {plone_group_id: number of direct members} for given p_plone_group_ids,
+        0 for empty or not existing groups. Memberships are read in one pass over
+        the source_groups storage, no user nor group is loaded.
+    """
+    plone_group_ids = set(plone_group_ids)
+    counts = dict([(plone_group_id, 0) for plone_group_id in plone_group_ids])
+    if plone_group_ids:
+        counts.update([(plone_group_id, len(member_ids))
+                       for plone_group_id, member_ids in _get_direct_members(plone_group_ids).items()])
+    return counts
+
+
+def get_not_empty_plone_groups(plone_group_ids, ignore_not_found=False):
+    """
+        Return the set of given p_plone_group_ids that exist and contain at least one member.
+        Memberships are read in one pass over the source_groups storage.
+        If p_ignore_not_found is True, members that can not be found anymore
+        ('<not found>' users) are ignored, like group.getGroupMembers does.
+    """
+    plone_group_ids = set(plone_group_ids)
+    if not plone_group_ids:
+        return set()
+    members = _get_direct_members(plone_group_ids)
+
+    if not ignore_not_found:
+        return set([plone_group_id for plone_group_id, member_ids in members.items() if member_ids])
+
+    acl_users = api.portal.get_tool('acl_users')
+    portal_groups = api.portal.get_tool('portal_groups')
+    found = {}
+
+    def principal_found(principal_id):
+        if principal_id not in found:
+            found[principal_id] = acl_users.getUserById(principal_id) is not None or \
+                portal_groups.getGroupById(principal_id) is not None
+        return found[principal_id]
+
+    return set([plone_group_id for plone_group_id, member_ids in members.items()
+                if [member_id for member_id in member_ids if principal_found(member_id)]])
+
+
 def get_plone_groups(org_uid, ids_only=False, suffixes=[]):
     """
         Return Plone groups linked to given org_uid.
@@ -64,11 +287,11 @@ def get_plone_groups(org_uid, ids_only=False, suffixes=[]):
     """
     suffixes = suffixes or get_all_suffixes(org_uid)
     plone_groups = [get_plone_group_id(org_uid, suffix) for suffix in suffixes]
-    plone_groups = [api.group.get(plone_group) for plone_group in plone_groups]
-    # remove None values
-    plone_groups = [v for v in plone_groups if v]
-    if ids_only:
-        plone_groups = [plone_group.getId() for plone_group in plone_groups]
+    plone_groups = [plone_group for plone_group in plone_groups if plone_group_exists(plone_group)]
+    if not ids_only:
+        plone_groups = [api.group.get(plone_group) for plone_group in plone_groups]
+        # remove None values
+        plone_groups = [v for v in plone_groups if v]
     return plone_groups
 
 
@@ -119,11 +342,14 @@ def get_organizations(only_selected=True,
         request = getRequest()
         if request:
             # in some cases like in tests, request can not be retrieved
-            key = "plonegroup-utils-get_organizations-{0}-{1}-{2}-{3}".format(
+            key = "plonegroup-utils-get_organizations-{0}-{1}-{2}-{3}-{4}-{5}".format(
                 not_empty_suffix or '',
                 str(only_selected),
                 str(the_objects),
-                '_'.join(sorted(kept_org_uids)))
+                '_'.join(sorted(kept_org_uids)),
+                get_plonegroup_generation(),
+                # Plone groups members are only used with not_empty_suffix
+                not_empty_suffix and get_plonegroup_membership_generation() or '')
             cache = IAnnotations(request)
             orgs = cache.get(key, None)
         else:
@@ -147,13 +373,11 @@ def get_organizations(only_selected=True,
                         if kept_org_uid in org_uids]
         # we only keep orgs for which Plone group with not_empty_suffix suffix contains members
         if not_empty_suffix:
-            filtered_orgs = []
-            for org_uid in org_uids:
-                plone_group_id = get_plone_group_id(org_uid, suffix=not_empty_suffix)
-                plone_group = api.group.get(plone_group_id)
-                if plone_group and plone_group.getMemberIds():
-                    filtered_orgs.append(org_uid)
-            org_uids = filtered_orgs
+            plone_group_ids = dict([(org_uid, get_plone_group_id(org_uid, suffix=not_empty_suffix))
+                                    for org_uid in org_uids])
+            not_empty_plone_group_ids = get_not_empty_plone_groups(plone_group_ids.values())
+            org_uids = [org_uid for org_uid in org_uids
+                        if plone_group_ids[org_uid] in not_empty_plone_group_ids]
 
         # return org uids or org objects
         if the_objects:
@@ -168,14 +392,221 @@ def get_organizations(only_selected=True,
     return orgs
 
 
+FULL_TITLES_CACHEKEY = 'collective.contact.plonegroup.full_titles'
+
+# {portal_path: (cachekey, {(org_uid, separator, first_index): (full_title, chain org_uids)})}
+_full_titles = {}
+
+
+def _get_full_titles_cache():
+    portal_path = '/'.join(api.portal.get().getPhysicalPath())
+    cachekey = get_cachekey_volatile(FULL_TITLES_CACHEKEY)
+    cached = _full_titles.get(portal_path)
+    if cached is None or cached[0] != cachekey:
+        cached = (cachekey, {})
+        _full_titles[portal_path] = cached
+    return cached[1]
+
+
+def _cache_full_title(cache, org, separator, first_index):
+    """Compute and cache full title of p_org if it is an organization."""
+    title = org.get_full_title(separator=separator, first_index=first_index)
+    if base_hasattr(org, 'get_organizations_chain'):
+        chain_uids = frozenset([chain_org.UID() for chain_org in org.get_organizations_chain()])
+        cache[(org.UID(), separator, first_index)] = (title, chain_uids)
+    return title
+
+
+def get_full_title(org, separator=u' / ', first_index=0):
+    """
+        Return org.get_full_title(separator, first_index), cached until the organization
+        or one of its parent organizations is modified or moved.
+    """
+    cache = _get_full_titles_cache()
+    cached = cache.get((org.UID(), separator, first_index))
+    if cached is not None:
+        return cached[0]
+    return _cache_full_title(cache, org, separator, first_index)
+
+
+def get_cached_full_title(uid, separator=u' / ', first_index=0):
+    """
+        Return cached full title of organization p_uid, None if not cached.
+    """
+    cached = _get_full_titles_cache().get((uid, separator, first_index))
+    return cached is not None and cached[0] or None
+
+
+def organization_title_changed(org, event):
+    """
+        Return True if modification p_event may have changed the full title of p_org.
+        When the event describes modified fields (edit form), the title field must be part of it,
+        either the titles of the Plone groups of p_org, stored before the modification,
+        are compared to the current full title.
+        Without Plone groups, True is returned if p_org contains sub contents using its title.
+    """
+    attributes = []
+    for description in getattr(event, 'descriptions', ()):
+        attributes.extend(getattr(description, 'attributes', ()))
+    if attributes and 'title' not in [attribute.split('.')[-1] for attribute in attributes]:
+        return False
+    org_uid = org.UID()
+    functions = get_functions_index().by_id
+    group_ids = dict([(get_plone_group_id(org_uid, suffix), suffix)
+                      for suffix in get_all_suffixes(org_uid)])
+    group_titles = get_plone_groups_titles(group_ids.keys())
+    if group_titles:
+        # the cached full title may already be the new one, it is not used
+        full_title = org.get_full_title(separator=' - ', first_index=1)
+        for group_id, title in group_titles.items():
+            fct_title = functions[group_ids[group_id]]['fct_title']
+            if safe_encode(title or '') != get_plone_group_title(full_title, fct_title):
+                return True
+        return False
+    if org.objectIds():
+        return True
+    cached = get_cached_full_title(org_uid, separator=' - ', first_index=1)
+    return cached is None or cached != org.get_full_title(separator=' - ', first_index=1)
+
+
+def get_full_titles(uids, separator=u' / ', first_index=0):
+    """
+        Return {uid: full title} for given organizations p_uids.
+        Only organizations which full title is not cached are loaded.
+    """
+    cache = _get_full_titles_cache()
+    titles = {}
+    missing = []
+    for uid in uids:
+        cached = cache.get((uid, separator, first_index))
+        if cached is None:
+            missing.append(uid)
+        else:
+            titles[uid] = cached[0]
+    if missing:
+        for org in uuidsToObjects(missing, ordered=False):
+            titles[org.UID()] = _cache_full_title(cache, org, separator, first_index)
+    return titles
+
+
+def _drop_full_titles(portal_path, org_uids):
+    cached = _full_titles.get(portal_path)
+    if cached is None:
+        return
+    cache = cached[1]
+    if None in org_uids:
+        cache.clear()
+        return
+    for key in [key for key, value in cache.items() if org_uids.intersection(value[1])]:
+        cache.pop(key, None)
+
+
+def _bump_full_titles(portal_path, org_uids):
+    # titles cached by other threads meanwhile may be outdated
+    _drop_full_titles(portal_path, org_uids)
+    invalidate_cachekey_volatile_for(FULL_TITLES_CACHEKEY)
+    cached = _full_titles.get(portal_path)
+    if cached is not None:
+        # keep titles not related to org_uids in this process
+        _full_titles[portal_path] = (get_cachekey_volatile(FULL_TITLES_CACHEKEY), cached[1])
+
+
+def _full_titles_after_commit(status, portal_path, org_uids):
+    # titles computed from the aborted state must be forgotten
+    if not status:
+        _drop_full_titles(portal_path, org_uids)
+
+
+# organizations which full titles changed in the current transaction, (transaction, org_uids)
+_full_titles_state = threading.local()
+
+
+def invalidate_full_titles(org_uid=None):
+    """
+        Invalidate cached full titles of organization p_org_uid and its sub organizations,
+        of every organizations if None.
+        Other processes will invalidate every cached full titles, once when the transaction is committed.
+    """
+    portal_path = '/'.join(api.portal.get().getPhysicalPath())
+    txn = transaction.get()
+    pending = getattr(_full_titles_state, 'pending', None)
+    if pending is None or pending[0] is not txn:
+        pending = (txn, set())
+        _full_titles_state.pending = pending
+        txn.addBeforeCommitHook(_bump_full_titles, args=(portal_path, pending[1]))
+        txn.addAfterCommitHook(_full_titles_after_commit, args=(portal_path, pending[1]))
+    pending[1].add(org_uid)
+    _drop_full_titles(portal_path, set([org_uid]))
+
+
+class FunctionsIndex(object):
+    """
+        Compiled view of the functions defined in the configuration.
+        Suffixes are always kept in the configuration order.
+        Every attribute is a dict with only_enabled (True/False) as key:
+        - suffixes: every suffixes;
+        - unrestricted: suffixes not restricted to some organizations (no fct_orgs);
+        - by_org: suffixes available for an organization UID used in a fct_orgs,
+          an organization not found in by_org only gets unrestricted suffixes.
+        by_id contains the function definition by function id.
+    """
+
+    def __init__(self, functions):
+        self.by_id = {}
+        self.suffixes = {True: [], False: []}
+        self.unrestricted = {True: [], False: []}
+        restricted_orgs = set([org_uid for function in functions for org_uid in function['fct_orgs']])
+        self.by_org = {True: dict([(org_uid, []) for org_uid in restricted_orgs]),
+                       False: dict([(org_uid, []) for org_uid in restricted_orgs])}
+        for function in functions:
+            fct_id = function['fct_id']
+            self.by_id[fct_id] = function
+            fct_orgs = function['fct_orgs'] and set(function['fct_orgs']) or restricted_orgs
+            for only_enabled in (True, False):
+                if only_enabled and not function['enabled']:
+                    continue
+                self.suffixes[only_enabled].append(fct_id)
+                if not function['fct_orgs']:
+                    self.unrestricted[only_enabled].append(fct_id)
+                for org_uid in fct_orgs:
+                    self.by_org[only_enabled][org_uid].append(fct_id)
+        for only_enabled in (True, False):
+            self.suffixes[only_enabled] = tuple(self.suffixes[only_enabled])
+            self.unrestricted[only_enabled] = tuple(self.unrestricted[only_enabled])
+            for org_uid, suffixes in self.by_org[only_enabled].items():
+                self.by_org[only_enabled][org_uid] = tuple(suffixes)
+
+    def get_suffixes(self, org_uid=None, only_enabled=True):
+        """Return suffixes, available for org_uid if given."""
+        only_enabled = bool(only_enabled)
+        if not org_uid:
+            return self.suffixes[only_enabled]
+        return self.by_org[only_enabled].get(org_uid, self.unrestricted[only_enabled])
+
+
+# {portal_path: (functions snapshot, FunctionsIndex)}
+_functions_indexes = {}
+
+
+def get_functions_index(rebuild=False):
+    """
+        Return the FunctionsIndex of the functions defined in the configuration.
+        It is only rebuilt when the FUNCTIONS_REGISTRY snapshot changed or if p_rebuild is True.
+    """
+    portal_path = '/'.join(api.portal.get().getPhysicalPath())
+    functions = get_registry_functions(frozen=True)
+    cached = _functions_indexes.get(portal_path)
+    if rebuild or cached is None or cached[0] is not functions:
+        cached = (functions, FunctionsIndex(functions))
+        _functions_indexes[portal_path] = cached
+    return cached[1]
+
+
 def get_all_suffixes(org_uid=None, only_enabled=True):
     """
         Get every suffixes defined in the configuration.
     """
-    functions = get_registry_functions()
-    return [function['fct_id'] for function in functions
-            if (not only_enabled or function['enabled']) and
-               (not org_uid or not function['fct_orgs'] or org_uid in function['fct_orgs'])]
+    return list(get_functions_index().get_suffixes(org_uid, only_enabled=only_enabled))
 
 
 def get_selected_org_suffix_users(org_uid, suffixes):
@@ -186,6 +617,8 @@ def get_selected_org_suffix_users(org_uid, suffixes):
     # only add to vocabulary users with these functions in the organization
     for function_id in suffixes:
         groupname = "{}_{}".format(org_uid, function_id)
+        if not plone_group_exists(groupname):
+            continue
         try:
             members = api.user.get_users(groupname=groupname)
         except GroupNotFoundError:  # suffix can be limited to some organization...
@@ -198,6 +631,47 @@ def get_selected_org_suffix_users(org_uid, suffixes):
     return org_members
 
 
+# {portal_path: (organizations snapshot, frozenset of selected org_uids)}
+_selected_organizations = {}
+
+
+def get_selected_organizations_set():
+    """
+        Return selected organization uids as a frozenset, only rebuilt when the ORGANIZATIONS_REGISTRY changed.
+    """
+    portal_path = '/'.join(api.portal.get().getPhysicalPath())
+    organizations = get_registry_organizations(frozen=True)
+    cached = _selected_organizations.get(portal_path)
+    if cached is None or cached[0] is not organizations:
+        cached = (organizations, frozenset(organizations))
+        _selected_organizations[portal_path] = cached
+    return cached[1]
+
+
+def get_user_organizations(user_id, suffixes, only_selected=True):
+    """
+        Return the set of organization uids for which p_user_id is member, directly or
+        through nested groups, of a Plone group using one of p_suffixes.
+        Memberships are read from the groups mapping, no group object is loaded.
+    """
+    if isinstance(suffixes, basestring):
+        suffixes = [suffixes]
+    mapping = get_groups_mapping()
+    if mapping is None:
+        user = api.user.get(userid=user_id)
+        if user is None:
+            return set()
+        orgs = set(organizations_with_suffixes(api.group.get_groups(user=user), suffixes))
+    else:
+        orgs = set()
+        for principal_id in [user_id] + list(get_principal_group_ids(user_id)):
+            for suffix in suffixes:
+                orgs.update(mapping.get_principal_orgs(principal_id, suffix))
+    if only_selected:
+        orgs.intersection_update(get_selected_organizations_set())
+    return orgs
+
+
 def voc_selected_org_suffix_users(org_uid, suffixes, first_member=None):
     """
         Return users vocabulary that belongs to suffixed groups related to selected organization.
@@ -249,23 +723,117 @@ def get_own_organization_path(not_found_value=None, default=True):
     return not_found_value
 
 
+_batch_state = threading.local()
+
+
+class PlonegroupBatch(object):
+    """
+        Registry modifications collected by plonegroup_batch.
+        organizations and functions are the pending values, None until modified.
+    """
+
+    def __init__(self):
+        self.organizations = None
+        self.functions = None
+        # set while writing the registry, detectContactPlonegroupChange then
+        # does nothing, Plone groups are synchronized once at the end
+        self.flushing = False
+
+    def get_organizations(self):
+        if self.organizations is None:
+            self.organizations = get_registry_organizations()
+        return self.organizations
+
+    def get_functions(self):
+        if self.functions is None:
+            self.functions = get_registry_functions()
+        return self.functions
+
+    def flush(self):
+        """
+            Write each modified record once, organizations first,
+            then apply Plone groups changes of both records in one plan.
+        """
+        # sync imports this module
+        from collective.contact.plonegroup.sync import get_sync_plan
+        from collective.contact.plonegroup.sync import sync_plan
+        organizations = functions = None
+        if self.organizations is not None and \
+           self.organizations != list(get_registry_organizations(frozen=True)):
+            organizations = self.organizations
+        if self.functions is not None and self.functions != get_registry_functions():
+            functions = self.functions
+        if organizations is None and functions is None:
+            return
+        # computed before writing as it compares with the registry values
+        plan = get_sync_plan(organizations=organizations, functions=functions)
+        self.flushing = True
+        try:
+            if organizations is not None:
+                set_registry_organizations(organizations)
+            if functions is not None:
+                set_registry_functions(functions)
+        finally:
+            self.flushing = False
+        if sync_plan(plan):
+            invalidate_plonegroup_caches()
+
+
+def get_plonegroup_batch():
+    """Return the current PlonegroupBatch or None."""
+    return getattr(_batch_state, 'batch', None)
+
+
+@contextmanager
+def plonegroup_batch():
+    """
+        Collect select_organization and select_org_for_function calls and
+        write the registry once when leaving the context, so groups are
+        synchronized and caches invalidated only once.
+        Nothing is written if an exception is raised.
+        Registry is not modified inside the context, pending values are
+        available on the yielded PlonegroupBatch.
+    """
+    batch = get_plonegroup_batch()
+    if batch is not None:
+        # nested, the outermost batch will write the registry
+        yield batch
+        return
+    batch = _batch_state.batch = PlonegroupBatch()
+    try:
+        yield batch
+        batch.flush()
+    finally:
+        _batch_state.batch = None
+
+
 def select_organization(org_uid, remove=False):
     """Select organization in ORGANIZATIONS_REGISTRY."""
-    plonegroup_organizations = get_registry_organizations()
+    batch = get_plonegroup_batch()
+    if batch is not None:
+        plonegroup_organizations = batch.get_organizations()
+    else:
+        plonegroup_organizations = get_registry_organizations()
     if remove:
         plonegroup_organizations.remove(org_uid)
     else:
         plonegroup_organizations.append(org_uid)
-    set_registry_organizations(plonegroup_organizations)
+    if batch is None:
+        set_registry_organizations(plonegroup_organizations)
 
 
 def select_org_for_function(org_uid, function_id, remove=False):
     """Select an organization UID in the list of fct_orgs of a function."""
-    functions = get_registry_functions()
+    batch = get_plonegroup_batch()
+    if batch is not None:
+        functions = batch.get_functions()
+    else:
+        functions = get_registry_functions()
     for function in functions:
         if function['fct_id'] == function_id:
             if remove and org_uid in function['fct_orgs']:
                 function['fct_orgs'].remove(org_uid)
             elif org_uid not in function['fct_orgs']:
                 function['fct_orgs'].append(org_uid)
-    set_registry_functions(functions)
+    if batch is None:
+        set_registry_functions(functions)
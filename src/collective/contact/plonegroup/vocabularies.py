@@ -5,7 +5,7 @@ from collective.contact.core.vocabulary import PositionTypes
 from collective.contact.plonegroup.config import DEFAULT_DIRECTORY_ID
 from collective.contact.plonegroup.config import get_registry_functions
 from collective.contact.plonegroup.utils import get_all_suffixes
-from operator import methodcaller
+from collective.contact.plonegroup.utils import get_full_title
 from plone import api
 from z3c.form.term import ChoiceTermsVocabulary
 from zope.component import getUtility
@@ -33,7 +33,7 @@ class FunctionsVocabulary(object):
     implements(IVocabularyFactory)
 
     def __call__(self, context):
-        functions = get_registry_functions()
+        functions = get_registry_functions(frozen=True)
         terms = []
         for function in functions:
             terms.append(
@@ -93,8 +93,8 @@ class OrganizationsTerms(ChoiceTermsVocabulary):
         # like 'form.widgets.encodeur.0'
         fieldname = self.form.__parent__.name.split('.')[2]
         terms = []
-        for org in sorted(mainform.functions_orgs[fieldname], key=methodcaller('get_full_title')):
-            terms.append(SimpleTerm(org.UID(), title=org.get_full_title(separator=' - ', first_index=1)))
+        for org in sorted(mainform.functions_orgs[fieldname], key=get_full_title):
+            terms.append(SimpleTerm(org.UID(), title=get_full_title(org, separator=' - ', first_index=1)))
         self.terms = SimpleVocabulary(terms)
         field.vocabulary = self.terms
 